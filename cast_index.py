@@ -0,0 +1,296 @@
+"""A persistent index of casts, their sensors and how they were processed.
+
+Parsing every hex and xmlcon of an archive to find out which casts have a SPAR sensor, which are
+missing coordinates or which were processed with an old psa_filter.yaml takes a long time.
+The index keeps this per cast in a SQLite database. It is refreshed incrementally: files whose
+size and modification time are unchanged are not read again, so opening the index of a large
+archive only costs a stat per file.
+
+    index = CastIndex('data/cast_index.sqlite')
+    index.refresh(tunatools.discover_casts('data/raw'))
+    index.with_sensor('SPAR_Sensor')
+    index.missing_coordinates()
+    index.outdated('psa_filter.yaml')
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import sqlite3
+import time
+import warnings
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import sources
+import tunatools
+
+
+def file_hash(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    with sources.open_source(path, 'rb') as opened_file:
+        for chunk in iter(lambda: opened_file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def config_hashes() -> dict:
+    """Hashes of the configuration the psa files are built from, relative name -> hash."""
+    config_folder = Path(tunatools.get_base_path(), 'config')
+    return {config_file.relative_to(config_folder).as_posix(): file_hash(config_file)
+            for config_file in sorted(config_folder.rglob('*'))
+            if config_file.suffix in ('.yaml', '.psa')}
+
+
+def read_sources(paths, header_only=()) -> dict:
+    """Path -> (sha1, content) of each existing path, read once: the hash and the content come from the same read.
+    The content is the header up to *END* for the suffixes in header_only, else the whole file.
+    Members of the same archive are read in one pass, a tar.gz would be decompressed again for every member otherwise."""
+    def digest(path: Path, opened_file) -> tuple[str, bytes]:
+        sha1 = hashlib.sha1()
+        content = bytearray()
+        keep = True
+        for chunk in iter(lambda: opened_file.read(1 << 20), b''):
+            sha1.update(chunk)
+            if keep:
+                content += chunk
+                end = content.find(b'*END*') if path.suffix in header_only else -1
+                if end >= 0 and content.find(b'\n', end) >= 0:
+                    del content[content.find(b'\n', end) + 1:]
+                    keep = False
+        return sha1.hexdigest(), bytes(content)
+
+    read = dict()
+    # archive -> {member: path}
+    in_archives = dict()
+    for path in paths:
+        location = sources.locate(path)
+        if location is None:
+            continue
+        if location[0] == 'archive':
+            in_archives.setdefault(location[1], dict())[location[2]] = path
+            continue
+        with sources.open_source(path, 'rb') as opened_file:
+            read[path] = digest(path, opened_file)
+    for archive, members in in_archives.items():
+        for member, opened_file in sources.stream_members(archive, set(members)):
+            read[members[member]] = digest(members[member], opened_file)
+    return read
+
+
+def file_state(path: Path):
+    """(size, mtime) or None if the file doesn't exist, this is what decides if a file is read again."""
+    return sources.state(path)
+
+
+class CastIndex:
+    def __init__(self, db_file: Path = Path('data', 'cast_index.sqlite')):
+        self.db_file = Path(db_file)
+        if not self.db_file.parent.is_dir():
+            self.db_file.parent.mkdir(parents=True)
+        with self.connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS casts (
+                    hex TEXT PRIMARY KEY,
+                    stem TEXT NOT NULL,
+                    hex_state TEXT,
+                    hex_hash TEXT,
+                    xmlcon TEXT,
+                    xmlcon_state TEXT,
+                    xmlcon_hash TEXT,
+                    bl TEXT,
+                    bl_state TEXT,
+                    bl_valid INTEGER,
+                    latitude REAL,
+                    longitude REAL,
+                    system_utc TEXT,
+                    pressure_serial TEXT,
+                    processed REAL,
+                    processed_hex_hash TEXT,
+                    processed_xmlcon_hash TEXT,
+                    processed_config TEXT,
+                    psa_files TEXT,
+                    outputs TEXT,
+                    stage_durations TEXT
+                );
+                CREATE TABLE IF NOT EXISTS sensors (
+                    hex TEXT NOT NULL REFERENCES casts(hex) ON DELETE CASCADE,
+                    sensor TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (hex, sensor)
+                );
+                CREATE INDEX IF NOT EXISTS sensors_sensor ON sensors (sensor);
+            """)
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.db_file, timeout=60.)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA foreign_keys = ON")
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def refresh(self, hex_files, folders=None) -> list[Path]:
+        """Brings the index up to date for the casts, returns the ones that were (re)read.
+        The xmlcon and bl are expected next to the hex with the same stem.
+        Casts in the folders (default: the folders of the hex files) that are not among the hex files
+        don't exist anymore and are removed from the index."""
+        hex_files = [Path(hex_file).absolute() for hex_file in hex_files]
+        if folders is None:
+            folders = {hex_file.parent for hex_file in hex_files}
+        folders = [Path(folder).absolute() for folder in folders]
+        with self.connect() as db:
+            current = {str(hex_file) for hex_file in hex_files}
+            gone = [(row['hex'],) for row in db.execute("SELECT hex FROM casts")
+                    if row['hex'] not in current and any(Path(row['hex']).is_relative_to(folder) for folder in folders)]
+            db.executemany("DELETE FROM casts WHERE hex = ?", gone)
+            known = {row['hex']: row for row in
+                     db.execute("SELECT hex, hex_state, xmlcon_state, bl_state FROM casts")}
+            changed = dict()
+            for hex_file in hex_files:
+                states = [json.dumps(file_state(hex_file.with_suffix(suffix)))
+                          for suffix in ('.hex', '.xmlcon', '.bl')]
+                row = known.get(str(hex_file))
+                if row and [row['hex_state'], row['xmlcon_state'], row['bl_state']] == states:
+                    continue
+                changed[hex_file] = states
+            read = read_sources([hex_file.with_suffix(suffix) for hex_file in changed
+                                 for suffix in ('.hex', '.xmlcon', '.bl')], header_only=('.hex',))
+            for hex_file, states in changed.items():
+                self.read_cast(db, hex_file, states, read)
+        return list(changed)
+
+    def read_cast(self, db: sqlite3.Connection, hex_file: Path, states: list[str], read: dict | None = None):
+        """Parses the header of the hex, the xmlcon and the bl of one cast into the index.
+        read are the files as returned by read_sources, they are read here if missing."""
+        hex_state, xmlcon_state, bl_state = states
+        xmlcon = hex_file.with_suffix('.xmlcon')
+        bl = hex_file.with_suffix('.bl')
+        if read is None:
+            read = read_sources([hex_file, xmlcon, bl], header_only=('.hex',))
+        hex_hash, header = read[hex_file]
+        header = header.decode(errors='replace').replace('\r\n', '\n')
+        coords = tunatools.parse_header_lat_lon(header) or (None, None)
+        system_utc = tunatools.parse_header_system_utc(header)
+
+        xmlcon_hash, pressure_serial, sensors = None, None, dict()
+        if xmlcon in read:
+            xmlcon_hash, xmlcon_content = read[xmlcon]
+            try:
+                xmlcon_xml = ET.fromstring(xmlcon_content)
+            except ET.ParseError as e:
+                # One broken xmlcon shouldn't stop indexing the cruise, the cast just has no sensors
+                warnings.warn(f"Can't parse {xmlcon}: {e}")
+            else:
+                pressure_serial = xmlcon_xml.findtext('.//PressureSensor/SerialNumber')
+                for sensor in tunatools.sensor_inventory(xmlcon_xml):
+                    if sensor != 'NotInUse':
+                        sensors[sensor] = sensors.get(sensor, 0) + 1
+
+        db.execute("""INSERT INTO casts (hex, stem) VALUES (?, ?)
+                      ON CONFLICT (hex) DO NOTHING""", (str(hex_file), hex_file.stem))
+        db.execute("""UPDATE casts SET hex_state = ?, hex_hash = ?, xmlcon = ?, xmlcon_state = ?, xmlcon_hash = ?,
+                      bl = ?, bl_state = ?, bl_valid = ?, latitude = ?, longitude = ?, system_utc = ?,
+                      pressure_serial = ? WHERE hex = ?""",
+                   (hex_state, hex_hash, str(xmlcon) if xmlcon_hash else None, xmlcon_state, xmlcon_hash,
+                    str(bl) if bl in read else None, bl_state,
+                    int(tunatools.valid_bl_content(read[bl][1])) if bl in read else None,
+                    coords[0], coords[1], system_utc.isoformat() if system_utc else None,
+                    pressure_serial, str(hex_file)))
+        db.execute("DELETE FROM sensors WHERE hex = ?", (str(hex_file),))
+        db.executemany("INSERT INTO sensors (hex, sensor, count) VALUES (?, ?, ?)",
+                       [(str(hex_file), sensor, count) for sensor, count in sensors.items()])
+
+    def record(self, hex_file: Path, measurement):
+        """Stores how the cast was processed, call this after measurement.just_do_stuff()."""
+        hex_file = Path(hex_file).absolute()
+        stems = [measurement.hex.stem, f'{measurement.hex.stem}_u']
+        outputs = sorted({str(output) for stem in stems for output in measurement.output_folder.glob(f'{stem}.*')}
+                         | {str(Path(product).absolute()) for product in getattr(measurement, 'products', [])})
+        with self.connect() as db:
+            db.execute("""UPDATE casts SET processed = ?, processed_hex_hash = hex_hash,
+                          processed_xmlcon_hash = xmlcon_hash, processed_config = ?,
+                          psa_files = ?, outputs = ?, stage_durations = ? WHERE hex = ?""",
+                       (time.time(), json.dumps(config_hashes()),
+                        json.dumps({name: str(psa) for name, psa in measurement.processed_psa.items()}),
+                        json.dumps(outputs), json.dumps(measurement.stage_durations), str(hex_file)))
+
+    def needs_processing(self, hex_file: Path) -> bool:
+        """False only if the cast was processed from the same hex, xmlcon and configuration
+        and its outputs (including the SHARKtools copy and the QC results) still exist."""
+        cast = self.get(hex_file)
+        if not cast or not cast['processed']:
+            return True
+        if (cast['processed_hex_hash'] != cast['hex_hash']
+                or cast['processed_xmlcon_hash'] != cast['xmlcon_hash']
+                or cast['processed_config'] != config_hashes()):
+            return True
+        return not all(Path(output).is_file() for output in cast['outputs'])
+
+    def get(self, hex_file: Path) -> dict:
+        casts = self.query("SELECT * FROM casts WHERE hex = ?", (str(Path(hex_file).absolute()),))
+        return casts[0] if casts else None
+
+    def query(self, sql: str, parameters=()) -> list[dict]:
+        """Runs any query against the index, the json columns are decoded."""
+        with self.connect() as db:
+            casts = [dict(row) for row in db.execute(sql, parameters)]
+        for cast in casts:
+            for column in ('processed_config', 'psa_files', 'outputs', 'stage_durations'):
+                if cast.get(column):
+                    cast[column] = json.loads(cast[column])
+        return casts
+
+    def sensors(self, hex_file: Path) -> dict:
+        """Sensor type -> number of channels of the cast"""
+        with self.connect() as db:
+            return dict(db.execute("SELECT sensor, count FROM sensors WHERE hex = ?",
+                                   (str(Path(hex_file).absolute()),)).fetchall())
+
+    def with_sensor(self, sensor: str) -> list[dict]:
+        return self.query("SELECT casts.* FROM casts JOIN sensors USING (hex) WHERE sensor = ? ORDER BY hex",
+                          (sensor,))
+
+    def missing_coordinates(self) -> list[dict]:
+        """Casts without NMEA position in the hex header."""
+        return self.query("SELECT * FROM casts WHERE latitude IS NULL OR longitude IS NULL ORDER BY hex")
+
+    def unprocessed(self) -> list[dict]:
+        return self.query("SELECT * FROM casts WHERE processed IS NULL ORDER BY hex")
+
+    def processed_with(self, config_file: str, config_hash: str) -> list[dict]:
+        """Casts processed with a specific version (file_hash) of a configuration file, e.g. psa_filter.yaml"""
+        return [cast for cast in self.query("SELECT * FROM casts WHERE processed IS NOT NULL ORDER BY hex")
+                if cast['processed_config'].get(config_file) == config_hash]
+
+    def outdated(self, config_file: str | None = None) -> list[dict]:
+        """Casts processed with another version of the configuration file (any configuration if None)
+        than the current one."""
+        current = config_hashes()
+        casts = self.query("SELECT * FROM casts WHERE processed IS NOT NULL ORDER BY hex")
+        if config_file:
+            return [cast for cast in casts if cast['processed_config'].get(config_file) != current.get(config_file)]
+        return [cast for cast in casts if cast['processed_config'] != current]
+
+
+def process_folder(folder: Path, index_file: Path = Path('data', 'cast_index.sqlite'),
+                   measurement_class=tunatools.SHARKTOOLS_Measurement, force: bool = False,
+                   recursive: bool = False, **kwargs) -> list[Path]:
+    """Processes all casts of the folder that changed since they were last processed.
+    kwargs are passed on to the measurement. Returns the processed hex files."""
+    index = CastIndex(index_file)
+    hex_files = tunatools.discover_casts(folder, recursive=recursive)
+    index.refresh(hex_files, [folder])
+    processed = []
+    for hex_file in hex_files:
+        if not force and not index.needs_processing(hex_file):
+            continue
+        sm = measurement_class(hex_file, source_folder=hex_file.parent, **kwargs)
+        sm.just_do_stuff()
+        index.record(hex_file, sm)
+        processed.append(hex_file)
+    return processed
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""A stand-in for sbebatch.exe to run the pipeline without SBE Data Processing (e.g. on Linux).
+
+It is called like sbebatch (fake_sbebatch.py batch_file output_folder) and goes through the lines of
+the batch file: datcnv writes a small made up cnv (and the .ros if the psa asks for it), bottlesum a .btl
+and every other stage copies its input to its output with a note in the header. Only the file names and
+the data flow are real, the numbers are not.
+
+    sm = SHARKTOOLS_Measurement('cast1', sbebatch='/path/to/fake_sbebatch.py')
+
+FAKE_SBEBATCH_DELAY (seconds per stage) makes the casts slow, for trying leases and heartbeats.
+"""
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+HEADER = """* Sea-Bird SBE 9 Data File:
+* FileName = {hex}
+# nquan = 3
+# nvalues = {scans}
+# name 0 = prDM: Pressure, Digiquartz [db]
+# name 1 = t090C: Temperature [ITS-90, deg C]
+# name 2 = c0S/m: Conductivity [S/m]
+# interval = seconds: 0.0416667
+# bad_flag = -9.990e-29
+# datcnv_date = {date}, fake_sbebatch
+*END*
+"""
+
+
+def parse_line(line: str) -> tuple[str, dict]:
+    """'datcnv /pX.psa /oout /cY.xmlcon /iZ.hex' -> ('datcnv', {'p': 'X.psa', 'o': 'out', ...})"""
+    name, _, rest = line.strip().partition(' ')
+    options = dict((key, value.strip()) for key, value in re.findall(r'/([pocia])(.*?)(?=\s/[pocia]|$)', rest))
+    return name, options
+
+
+def fake_cnv(hex_file: Path, scans: int = 50) -> str:
+    rows = [f'{p:11.3f}{10 - p / 20:11.4f}{3.5 - p / 200:11.6f}' for p in range(1, scans + 1)]
+    return HEADER.format(hex=hex_file.name, scans=scans, date=time.strftime('%b %d %Y %H:%M:%S')) + '\n'.join(rows) + '\n'
+
+
+def run_stage(name: str, options: dict, output_folder: Path):
+    input_file = Path(options['i'])
+    output_folder = Path(options.get('o', output_folder))
+    if not input_file.is_file():
+        raise FileNotFoundError(f'{name}: there is no {input_file}')
+    if name == 'datcnv':
+        output = Path(output_folder, input_file.stem + options.get('a', '')).with_suffix('.cnv')
+        output.write_text(fake_cnv(input_file))
+        create_file = ET.parse(options['p']).getroot().find('CreateFile')
+        if create_file is not None and create_file.get('value') == '2':
+            output.with_suffix('.ros').write_text(output.read_text())
+    elif name == 'bottlesum':
+        Path(output_folder, input_file.stem).with_suffix('.btl').write_text(f'* bottle summary of {input_file.name}\n')
+    else:
+        lines = input_file.read_text().splitlines(keepends=True)
+        end = next(i for i, line in enumerate(lines) if line.startswith('*END*'))
+        lines.insert(end, f'# {name}_date = {time.strftime("%b %d %Y %H:%M:%S")}, fake_sbebatch\n')
+        Path(output_folder, input_file.stem).with_suffix('.cnv').write_text(''.join(lines))
+
+
+def main(argv=None) -> int:
+    batch_file, output_folder = (argv or sys.argv[1:])[:2]
+    delay = float(os.environ.get('FAKE_SBEBATCH_DELAY', 0))
+    with open(batch_file) as opened_batch_file:
+        for line in opened_batch_file:
+            if not line.strip():
+                continue
+            name, options = parse_line(line)
+            time.sleep(delay)
+            try:
+                run_stage(name, options, Path(output_folder))
+            except Exception as e:
+                print(e, file=sys.stderr)
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
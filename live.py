@@ -0,0 +1,359 @@
+"""Live processing of a hex file while Seasave is still writing it.
+
+The header is parsed once, then new complete scan lines are read as they are appended, converted
+with the coefficients of the xmlcon of the measurement and added to running pressure bins and a
+simple QC summary. Every update handles at most max_scans scans, so the time per update is bounded
+even when catching up with a long cast.
+
+    python live.py follow data/raw/EL19-IGV01_CTD04.hex
+    python live.py replay data/raw/EL19-IGV01_CTD04.hex data/live/EL19-IGV01_CTD04.hex --speed 10
+
+Only the frequency sensors (temperature, conductivity, Digiquartz pressure) are converted,
+A/D channels are kept as voltages.
+"""
+import argparse
+import math
+import re
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import sources
+import tunatools
+
+# Sea-Bird 911plus: 24 scans per second
+SCAN_RATE = 24.
+BAD_FLAG = -9.990e-29
+
+# Plausible values per variable, anything outside is counted by the QC
+DEFAULT_RANGES = {
+    'pressure': (-5., 12000.),
+    'temperature': (-2.5, 40.),
+    'temperature2': (-2.5, 40.),
+    'conductivity': (0., 7.),
+    'conductivity2': (0., 7.),
+    'salinity': (0., 42.),
+    'salinity2': (0., 42.),
+}
+
+
+def coefficient(element: ET.Element, name: str, default: float = 0.) -> float:
+    value = element.findtext(name)
+    return float(value) if value not in (None, '') else default
+
+
+def temperature_sbe3(frequency: float, sensor: ET.Element) -> float:
+    """ITS-90 temperature [deg C] from the frequency of a SBE 3, G-J coefficients."""
+    if frequency <= 0:
+        return BAD_FLAG
+    ln = math.log(coefficient(sensor, 'F0', 1000.) / frequency)
+    t = 1. / (coefficient(sensor, 'G') + coefficient(sensor, 'H') * ln + coefficient(sensor, 'I') * ln ** 2
+              + coefficient(sensor, 'J') * ln ** 3) - 273.15
+    return coefficient(sensor, 'Slope', 1.) * t + coefficient(sensor, 'Offset')
+
+
+def conductivity_sbe4(frequency: float, temperature: float, pressure: float, sensor: ET.Element) -> float:
+    """Conductivity [S/m] from the frequency of a SBE 4, G-J coefficients (equation 1 in the xmlcon)."""
+    coefficients = sensor.find("Coefficients[@equation='1']")
+    if coefficients is None:
+        coefficients = sensor
+    f = frequency / 1000.
+    c = ((coefficient(coefficients, 'G') + coefficient(coefficients, 'H') * f ** 2
+          + coefficient(coefficients, 'I') * f ** 3 + coefficient(coefficients, 'J') * f ** 4)
+         / (10 * (1 + coefficient(coefficients, 'CTcor') * temperature + coefficient(coefficients, 'CPcor') * pressure)))
+    return coefficient(sensor, 'Slope', 1.) * c + coefficient(sensor, 'Offset')
+
+
+def pressure_digiquartz(frequency: float, compensation: int, sensor: ET.Element) -> float:
+    """Pressure [db] of a Digiquartz with temperature compensation (the 12 bit word of the scan)."""
+    if frequency <= 0:
+        return BAD_FLAG
+    u = coefficient(sensor, 'AD590M') * compensation + coefficient(sensor, 'AD590B')
+    c = coefficient(sensor, 'C1') + coefficient(sensor, 'C2') * u + coefficient(sensor, 'C3') * u ** 2
+    d = coefficient(sensor, 'D1') + coefficient(sensor, 'D2') * u
+    t0 = (coefficient(sensor, 'T1') + coefficient(sensor, 'T2') * u + coefficient(sensor, 'T3') * u ** 2
+          + coefficient(sensor, 'T4') * u ** 3 + coefficient(sensor, 'T5') * u ** 4)
+    # period in microseconds
+    ratio = 1 - (t0 * frequency / 1e6) ** 2
+    psia = c * ratio * (1 - d * ratio)
+    psia = coefficient(sensor, 'Slope', 1.) * psia + coefficient(sensor, 'Offset')
+    return (psia - 14.7) * 0.689476
+
+
+def practical_salinity(conductivity: float, temperature: float, pressure: float) -> float:
+    """PSS-78 salinity from conductivity [S/m], ITS-90 temperature [deg C] and pressure [db]."""
+    if BAD_FLAG in (conductivity, temperature, pressure) or conductivity <= 0:
+        return BAD_FLAG
+    t = temperature * 1.00024
+    r = conductivity / 4.2914
+    rt = 0.6766097 + t * (2.00564e-2 + t * (1.104259e-4 + t * (-6.9698e-7 + t * 1.0031e-9)))
+    rp = 1 + pressure * (2.070e-5 + pressure * (-6.370e-10 + pressure * 3.989e-15)) \
+        / (1 + 3.426e-2 * t + 4.464e-4 * t ** 2 + (4.215e-1 - 3.107e-3 * t) * r)
+    rt = r / (rp * rt)
+    if rt <= 0:
+        return BAD_FLAG
+    a = (0.0080, -0.1692, 25.3851, 14.0941, -7.0261, 2.7081)
+    b = (0.0005, -0.0056, -0.0066, -0.0375, 0.0636, -0.0144)
+    root = math.sqrt(rt)
+    s = sum(ai * root ** i for i, ai in enumerate(a))
+    ds = sum(bi * root ** i for i, bi in enumerate(b)) * (t - 15) / (1 + 0.0162 * (t - 15))
+    return s + ds
+
+
+class HexScanDecoder:
+    """Decodes the scan lines of a SBE 911plus hex file and converts the frequency sensors."""
+    def __init__(self, xmlcon: Path):
+        with sources.open_source(xmlcon, 'rb') as opened_xmlcon_file:
+            root = ET.parse(opened_xmlcon_file).getroot()
+        instrument = root.find('.//Instrument')
+
+        def flag(name):
+            return instrument.findtext(name, '0').strip() == '1'
+
+        self.frequencies = 5 - int(instrument.findtext('FrequencyChannelsSuppressed', '0'))
+        self.voltages = 2 * (4 - int(instrument.findtext('VoltageWordsSuppressed', '0')))
+        # Bytes per scan, in the order they are written by the deck unit and Seasave
+        self.surface_par = flag('SurfaceParVoltageAdded')
+        self.nmea_position = flag('NmeaPositionDataAdded')
+        self.nmea_depth = flag('NmeaDepthDataAdded')
+        self.nmea_time = flag('NmeaTimeAdded')
+        self.scan_time = flag('ScanTimeAdded')
+        self.bytes_per_scan = (3 * self.frequencies + 3 * self.voltages // 2 + 3 * self.surface_par
+                               + 7 * self.nmea_position + 3 * self.nmea_depth + 4 * self.nmea_time
+                               + 3 + 4 * self.scan_time)
+
+        # Sensor index 0-4 are the frequency channels, the rest the A/D channels
+        self.sensors = {int(sensor.get('index')): sensor[0] for sensor in root.findall('.//SensorArray/Sensor')
+                        if len(sensor)}
+
+    def decode(self, line: str) -> dict:
+        """The raw values of a scan: frequencies [Hz], voltages [V], pressure temperature word, status, modulo count."""
+        data = bytes.fromhex(line.strip())
+        if len(data) != self.bytes_per_scan:
+            raise ValueError(f"Scan has {len(data)} bytes instead of {self.bytes_per_scan}")
+        raw = {'frequencies': [], 'voltages': []}
+        i = 0
+        for _ in range(self.frequencies):
+            raw['frequencies'].append(data[i] * 256 + data[i + 1] + data[i + 2] / 256)
+            i += 3
+        for _ in range(self.voltages // 2):
+            word = int.from_bytes(data[i:i + 3], 'big')
+            raw['voltages'] += [5 * (1 - (word >> 12) / 4095), 5 * (1 - (word & 0xFFF) / 4095)]
+            i += 3
+        # Surface PAR and NMEA data are not used live
+        i += 3 * self.surface_par + 7 * self.nmea_position + 3 * self.nmea_depth + 4 * self.nmea_time
+        word = int.from_bytes(data[i:i + 3], 'big')
+        raw['pressure_temperature'] = word >> 12
+        raw['status'] = (word >> 8) & 0xF
+        raw['modulo'] = word & 0xFF
+        i += 3
+        if self.scan_time:
+            raw['system_time'] = int.from_bytes(data[i:i + 4], 'little')
+        return raw
+
+    def convert(self, raw: dict) -> dict:
+        """Engineering units of the frequency sensors: pressure, temperature, conductivity (and salinity),
+        the second sensor pair with a 2 appended."""
+        values = {}
+        frequencies = raw['frequencies']
+        pressure_sensor = self.sensors.get(2)
+        if pressure_sensor is not None and pressure_sensor.tag == 'PressureSensor' and len(frequencies) > 2:
+            values['pressure'] = pressure_digiquartz(frequencies[2], raw['pressure_temperature'], pressure_sensor)
+        pressure = values.get('pressure', 0.)
+        for t_index, c_index, suffix in ((0, 1, ''), (3, 4, '2')):
+            t_sensor, c_sensor = self.sensors.get(t_index), self.sensors.get(c_index)
+            if t_sensor is None or t_sensor.tag != 'TemperatureSensor' or len(frequencies) <= t_index:
+                continue
+            temperature = temperature_sbe3(frequencies[t_index], t_sensor)
+            values[f'temperature{suffix}'] = temperature
+            if c_sensor is None or c_sensor.tag != 'ConductivitySensor' or len(frequencies) <= c_index:
+                continue
+            conductivity = conductivity_sbe4(frequencies[c_index], temperature, pressure, c_sensor)
+            values[f'conductivity{suffix}'] = conductivity
+            if 'pressure' in values:
+                values[f'salinity{suffix}'] = practical_salinity(conductivity, temperature, pressure)
+        for i, voltage in enumerate(raw['voltages']):
+            values[f'voltage{i}'] = voltage
+        return values
+
+
+class LiveCast:
+    """Follows a growing hex file and keeps running pressure bins and QC counts up to date."""
+    def __init__(self, measurement: tunatools.SBE911_Measurement, bin_size: float = 1.,
+                 max_scans: int = 2400, downcast_only: bool = True, ranges: dict = DEFAULT_RANGES):
+        self.measurement = measurement
+        self.decoder = HexScanDecoder(measurement.xmlcon)
+        self.bin_size = bin_size
+        # Bounds the work (and with it the latency) of one update
+        self.max_scans = max_scans
+        self.downcast_only = downcast_only
+        self.ranges = ranges
+
+        self.header = None
+        self.header_lines = []
+        self.offset = 0
+        # A partly written last line, completed by the next read
+        self.partial = b''
+        self.pending = []
+        self.scans = 0
+        self.max_pressure = None
+        self.last_modulo = None
+        # bin index -> [scans, {variable: sum}]
+        self.bins = dict()
+        self.qc = {'scans': 0, 'bad_scans': 0, 'missed_scans': 0, 'out_of_range': dict(),
+                   'max_temperature_difference': 0., 'max_conductivity_difference': 0.}
+
+    def read_new_lines(self) -> list[str]:
+        """Complete lines appended since the last call, about max_scans of them at most so a long cast is caught
+        up with over several updates. A partly written last line is carried over to the next call."""
+        # A scan line is two hex characters per byte and the line ending
+        limit = self.max_scans * (2 * self.decoder.bytes_per_scan + 2)
+        # Binary, so the offset is in bytes whatever the line endings are
+        with open(self.measurement.hex, 'rb') as hex_file:
+            hex_file.seek(self.offset)
+            new_data = hex_file.read(limit)
+        self.offset += len(new_data)
+        data = self.partial + new_data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        lines = data[:end].decode('ascii', errors='replace').splitlines()
+        if self.header is None:
+            # The header is parsed once, scans only start after *END*
+            self.header_lines += lines
+            if not any(line.startswith('*END*') for line in lines):
+                return []
+            end_of_header = next(i for i, line in enumerate(self.header_lines) if line.startswith('*END*'))
+            self.header = '\n'.join(self.header_lines[:end_of_header + 1])
+            self.check_header()
+            lines, self.header_lines = self.header_lines[end_of_header + 1:], []
+        return [line for line in lines if line.strip()]
+
+    def check_header(self):
+        bytes_per_scan = re.search(r'^\* Number of Bytes Per Scan = (\d+)', self.header, re.M)
+        if bytes_per_scan and int(bytes_per_scan[1]) != self.decoder.bytes_per_scan:
+            raise ValueError(f"The hex has {bytes_per_scan[1]} bytes per scan, but the xmlcon describes "
+                             f"{self.decoder.bytes_per_scan}. Is it the right xmlcon?")
+
+    def update(self) -> int:
+        """Processes at most max_scans new scans, returns how many."""
+        if len(self.pending) < self.max_scans:
+            self.pending += self.read_new_lines()
+        todo, self.pending = self.pending[:self.max_scans], self.pending[self.max_scans:]
+        for line in todo:
+            self.add_scan(line)
+        return len(todo)
+
+    def add_scan(self, line: str):
+        self.scans += 1
+        self.qc['scans'] += 1
+        try:
+            raw = self.decoder.decode(line)
+        except ValueError:
+            self.qc['bad_scans'] += 1
+            return
+        if self.last_modulo is not None:
+            self.qc['missed_scans'] += (raw['modulo'] - self.last_modulo - 1) % 256
+        self.last_modulo = raw['modulo']
+        values = self.decoder.convert(raw)
+
+        for variable, (low, high) in self.ranges.items():
+            if variable in values and not low <= values[variable] <= high:
+                self.qc['out_of_range'][variable] = self.qc['out_of_range'].get(variable, 0) + 1
+        for variable in ('temperature', 'conductivity'):
+            if variable in values and f'{variable}2' in values:
+                difference = abs(values[variable] - values[f'{variable}2'])
+                self.qc[f'max_{variable}_difference'] = max(self.qc[f'max_{variable}_difference'], difference)
+
+        pressure = values.get('pressure')
+        if pressure is None or pressure == BAD_FLAG:
+            return
+        if self.downcast_only and self.max_pressure is not None and pressure < self.max_pressure:
+            return
+        self.max_pressure = pressure if self.max_pressure is None else max(self.max_pressure, pressure)
+        bin_values = self.bins.setdefault(math.floor(pressure / self.bin_size), [0, dict()])
+        bin_values[0] += 1
+        for variable, value in values.items():
+            if value != BAD_FLAG:
+                bin_values[1][variable] = bin_values[1].get(variable, 0.) + value
+
+    def profile(self) -> list[dict]:
+        """The binned profile so far, one dict per bin with the bin center pressure and the mean values."""
+        profile = []
+        for index in sorted(self.bins):
+            count, sums = self.bins[index]
+            row = {'bin': (index + 0.5) * self.bin_size, 'scans': count}
+            row.update({variable: total / count for variable, total in sums.items()})
+            profile.append(row)
+        return profile
+
+    def follow(self, interval: float = 1., idle_timeout: float = 60., callback=None):
+        """Updates until the file did not grow for idle_timeout seconds (the cast is over).
+        callback(live_cast, new_scans) is called after every update with new scans."""
+        idle_since = time.monotonic()
+        while True:
+            new_scans = self.update()
+            if new_scans:
+                idle_since = time.monotonic()
+                if callback:
+                    callback(self, new_scans)
+                if self.pending:
+                    # Catching up, don't wait
+                    continue
+            elif time.monotonic() - idle_since > idle_timeout:
+                return
+            time.sleep(interval)
+
+
+def replay(source: Path, target: Path, speed: float = 1., scan_rate: float = SCAN_RATE, chunk: float = 0.5):
+    """Writes an existing hex to target as Seasave would while acquiring: the header at once,
+    then the scans at scan_rate * speed scans per second, in chunks of chunk seconds."""
+    with sources.open_source(source, 'r') as hex_file:
+        lines = hex_file.readlines()
+    end_of_header = next(i for i, line in enumerate(lines) if line.startswith('*END*')) + 1
+    scans_per_chunk = max(1, int(scan_rate * speed * chunk))
+    with open(target, 'w') as live_file:
+        live_file.writelines(lines[:end_of_header])
+        live_file.flush()
+        for i in range(end_of_header, len(lines), scans_per_chunk):
+            start = time.monotonic()
+            live_file.writelines(lines[i:i + scans_per_chunk])
+            live_file.flush()
+            time.sleep(max(0., chunk - (time.monotonic() - start)))
+
+
+def print_update(live_cast: LiveCast, new_scans: int):
+    last = live_cast.profile()[-1] if live_cast.bins else {}
+    print(f"{live_cast.scans} scans, max pressure {live_cast.max_pressure or 0:.1f} db, "
+          f"last bin {', '.join(f'{k} {v:.3f}' for k, v in last.items() if not k.startswith('voltage'))}, "
+          f"missed {live_cast.qc['missed_scans']}, out of range {live_cast.qc['out_of_range']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    follow = commands.add_parser('follow', help='Follow a hex file while it is written')
+    follow.add_argument('hex')
+    follow.add_argument('--xmlcon', help='Defaults to the xmlcon with the same stem')
+    follow.add_argument('--bin-size', type=float, default=1.)
+    follow.add_argument('--interval', type=float, default=1.)
+    follow.add_argument('--idle-timeout', type=float, default=60.)
+
+    replay_parser = commands.add_parser('replay', help='Write an existing hex into a file at acquisition speed')
+    replay_parser.add_argument('source')
+    replay_parser.add_argument('target')
+    replay_parser.add_argument('--speed', type=float, default=1.)
+
+    args = parser.parse_args(argv)
+    if args.command == 'follow':
+        hex_file = Path(args.hex).absolute()
+        files = {'hex': hex_file, 'xmlcon': Path(args.xmlcon or hex_file.with_suffix('.xmlcon')).absolute()}
+        live_cast = LiveCast(tunatools.SBE911_Measurement(files, source_folder=hex_file.parent),
+                             bin_size=args.bin_size)
+        live_cast.follow(interval=args.interval, idle_timeout=args.idle_timeout, callback=print_update)
+    elif args.command == 'replay':
+        replay(Path(args.source), Path(args.target), speed=args.speed)
+
+
+if __name__ == "__main__":
+    main()
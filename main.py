@@ -1,5 +1,3 @@
-import os
-
 from PyQt6.QtWidgets import (
     QApplication,
     QDialog,
@@ -12,138 +10,22 @@ from PyQt6.QtWidgets import (
     QPlainTextEdit,
     QMessageBox,
     QLineEdit,
+    QCheckBox,
 )
 from PyQt6.QtCore import QProcess, QCoreApplication
 from PyQt6.QtGui import QIcon, QDoubleValidator
 import pathlib
 import tunatools
+import cast_index
+import subprocess
 import sys
-import re
-import datetime
-import dateutil.parser
 from multiprocessing import Pool
 
 class modified_Measurement(tunatools.SHARKTOOLS_Measurement):
     """An SBE911 Measurement with some overwrites to the class to make coordinates fixable on the flight!"""
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.shadow_hex()
-        self.shadow_xmlcon()
-
-    def shadow_hex(self) -> None:
-        """
-        SHARKtools crashes if there is no NMEA Latitude and Longitude.\n
-        So we offer the possibility to make a shadow file with a modified header.\n
-        This function fetches the shadow file if it exists and else allows for the creation.
-        """
-        with open(self.hex, 'r') as opened_hex_file:
-            hex_content = opened_hex_file.read()
-
-        # This assumes coordinates in the format 35 37.78 S. We don't know NMEA showing different data.
-        # In general maybe parsing should be outsourced.
-        lat = re.search(r'^\* NMEA Latitude = (\d{2}) ([\d\.]+) (\w)$',
-                        hex_content, re.M)
-        lon = re.search(r'^\* NMEA Longitude = (\d{3}) ([\d\.]+) (\w)$',
-                        hex_content, re.M)
-        lat_DD, lon_DD = None, None
-        if lat:
-            d, m, SN = lat.groups()
-            lat_DD = (-1 if SN == "S" else 1) * (int(d) + float(m) / 60.)
-        if lon:
-            d, m, EW = lon.groups()
-            lon_DD = (-1 if EW == "W" else 1) * (int(d) + float(m) / 60.)
-        if not lat_DD or not lon_DD:
-            shadow_folder = pathlib.Path(self.hex.parent, 'shadow')
-            if not shadow_folder.is_dir():
-                os.makedirs(shadow_folder)
-            shadow_file = pathlib.Path(shadow_folder, self.hex.name)
-            if shadow_file.is_file():
-                self.hex = shadow_file
-                return
-            coords = get_coords(self, lat_DD, lon_DD)
-            if coords:
-                lat_DD, lon_DD = coords
-                lat = f'* NMEA Latitude = {int(abs(lat_DD)):02d} {abs(lat_DD)%1*60:05.2f} {"N" if lat_DD>0 else "S"}'
-                lon = f'* NMEA Longitude = {int(abs(lon_DD)):03d} {abs(lon_DD)%1*60:05.2f} {"E" if lat_DD>0 else "W"}'
-                with open(shadow_file, 'w') as opened_hex_file:
-                    opened_hex_file.write(hex_content.replace('* SBE 11plus', f'{lat}\n{lon}\n* SBE 11plus', 1))
-                self.hex = shadow_file
-                possible_bl = self.hex.with_suffix('.bl')
-                if possible_bl.is_file() and tunatools.valid_bl_file(possible_bl):
-                    # Copying should be better...
-                    shadow_bl_file = pathlib.Path(shadow_folder, possible_bl.name)
-                    with open(shadow_bl_file) as opened_shadow_bl_file:
-                        with open(possible_bl, 'r') as bl_file:
-                            opened_shadow_bl_file.write(bl_file.read())
-
-
-    def shadow_xmlcon(self) -> None:
-        """
-        SHARKtools crashes if the calibration date of an instrument is not in one of a few
-        predetermined formats, hence we create a shadow xmlcon with the fixed date.
-        This function fetches the shadow file if it exists and else creates it.
-        """
-        """
-        While we could directly use dateutil.parser.parse and reparse them to a format we're sure
-        SHARKtools recognizes, this would result in a ton of shadow files. So we go through the
-        formats SHARKtools uses and keep the file intact if everything would be understood.
-        """
-        formats_sharktools_understands = [
-            '%d%m%y',
-            '%d%m%Y',
-            '%d-%b-%y',
-            '%d-%b-%Y',
-            '%d %b %y',
-            '%d %b %Y'
-        ]
-        shadow = False
-        shadow_folder = pathlib.Path(self.xmlcon.parent, 'shadow')
-        shadow_file = pathlib.Path(shadow_folder, self.xmlcon.name)
-
-        with open(self.xmlcon, 'r') as opened_xmlcon_file:
-            xmlcon_content = opened_xmlcon_file.read()
-        dates = re.findall(r'<CalibrationDate>(.*?)</CalibrationDate>', xmlcon_content)
-        for date in dates:
-            if not date:
-                continue
-            try:
-                for format in formats_sharktools_understands:
-                    try:
-                        datetime.datetime.strptime(date, format)
-                    except ValueError:
-                        # try the next format if this one doesn't work
-                        continue
-                    else:
-                        # this means something worked so we can skip this date
-                        raise StopIteration
-            except StopIteration:
-                # continue with the next date
-                continue
-            else:
-                # None of the formats worked!
-                shadow = True
-                new_date = ''
-                try:
-                    #You can pick any of the formats. This is personal preference
-                    new_date = dateutil.parser.parse(date).strftime(formats_sharktools_understands[3])
-                except dateutil.parser.ParserError:
-                    # Even dateutil doesn't know what this is suposed to says...
-                    # So we're fine just removing it! (If this doesn't work we can make the date 01/01/1970
-                    pass
-                finally:
-                    xmlcon_content = xmlcon_content.replace(date, new_date)
-        if shadow:
-            if not shadow_folder.is_dir():
-                os.makedirs(shadow_folder)
-
-            old_content = None
-            if shadow_file.is_file():
-                with open(shadow_file, 'r') as opened_xmlcon_file:
-                    old_content = opened_xmlcon_file.read()
-            if old_content != xmlcon_content:
-                with open(shadow_file, 'w') as opened_xmlcon_file:
-                    opened_xmlcon_file.write(xmlcon_content)
-            self.xmlcon = shadow_file
+    def ask_coords(self) -> (float, float):
+        # The dialog is the last resort, batch runs should configure a station log or a track
+        return get_coords(self)
 
 
 def get_coords(measurement, lat=None, lon=None):
@@ -197,9 +79,12 @@ class Window(QMainWindow):
 
         single_file = QPushButton('Process a file')
         folder = QPushButton('Process a folder')
+        # Casts that were already processed from the same files and configuration are skipped unless this is set
+        self.reprocess = QCheckBox('Reprocess unchanged casts')
 
         layout.addWidget(single_file, 0, 0)
         layout.addWidget(folder, 1, 0)
+        layout.addWidget(self.reprocess, 2, 0)
 
         single_file.clicked.connect(self.select_file)
         folder.clicked.connect(self.select_folder)
@@ -223,13 +108,20 @@ class Window(QMainWindow):
             QCoreApplication.processEvents()
 
             self.measurements = []
-            for file in pathlib.Path(self.directory).glob('*.hex'):
+            self.index = cast_index.CastIndex()
+            hex_files = tunatools.discover_casts(self.directory)
+            self.index.refresh(hex_files, [self.directory])
+            reprocess = self.reprocess.isChecked()
+            for file in hex_files:
+                if not reprocess and not self.index.needs_processing(file):
+                    venv_box.appendPlainText(f'{file.name} is unchanged since it was processed, skipping')
+                    continue
                 try:
                     sm = modified_Measurement(file, source_folder=file.parent)
                 except AssertionError as e:
                     venv_box.appendPlainText(f'{file} failed with error: {e}')
                 else:
-                    self.measurements.append(sm)
+                    self.measurements.append((file, sm))
                     venv_box.appendPlainText(f'{sm.hex.name} with xmlcon{"+bl" if getattr(sm, "bl", None) else ""}')
             self.continue_button.setText(f'Continue with {len(self.measurements)} files')
             self.continue_button.setEnabled(True)
@@ -306,9 +198,16 @@ class Window(QMainWindow):
         self.continue_button.clicked.connect(QApplication.instance().quit)
 
     def process(self):
-        for ms in self.measurements:
-            ms.just_do_stuff(force=True)
-        self.continue_button.setText('Done!')
+        failed = 0
+        for file, ms in self.measurements:
+            try:
+                ms.just_do_stuff(force=True)
+            except subprocess.CalledProcessError:
+                # Not recorded, so the cast is offered again next time
+                failed += 1
+                continue
+            self.index.record(file, ms)
+        self.continue_button.setText(f'Done! ({failed} casts failed)' if failed else 'Done!')
         self.continue_button.clicked.disconnect()
         self.continue_button.clicked.connect(QApplication.instance().quit)
 
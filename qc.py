@@ -0,0 +1,182 @@
+"""Automatic QC of processed casts before they go to SHARKtools.
+
+The processed (binned) cnv is tested column by column as configured in config/qc.yaml: range tests,
+spikes against a rolling median, gradients against pressure and primary vs secondary sensors.
+All tests work on whole columns at once, so a cruise is done in seconds.
+
+Per cast, qc/{stem}_qc_flags.csv gets the pressure of every bin and one flag column per tested variable
+(a sum of the bits below, 0 is good) and qc/{stem}_qc.yaml a summary. For a folder, qc/qc_summary.csv has one line per cast.
+
+    python qc.py data/output
+"""
+import argparse
+import csv
+import functools
+import warnings
+from pathlib import Path
+
+import numpy as np
+import yaml
+from numpy.lib.stride_tricks import sliding_window_view
+
+import stages
+
+# Flag bits
+RANGE = 1
+SPIKE = 2
+GRADIENT = 4
+PAIR = 8
+FLAG_NAMES = {RANGE: 'range', SPIKE: 'spike', GRADIENT: 'gradient', PAIR: 'pair'}
+
+
+@functools.lru_cache(maxsize=None)
+def load_config(config: str = 'qc.yaml') -> dict:
+    with open(Path(Path(__file__).parent, 'config', config)) as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def rolling_median(values: np.ndarray, window: int) -> np.ndarray:
+    """Median of the window centered on every value, the edges are padded with the first/last value."""
+    half = window // 2
+    if not len(values):
+        # Edge padding needs a value
+        return values.astype(float)
+    padded = np.pad(values, half, mode='edge')
+    with warnings.catch_warnings():
+        # Windows that are all missing values give nan, which is never flagged
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(sliding_window_view(padded, 2 * half + 1), axis=1)
+
+
+def range_test(values: np.ndarray, low: float = -np.inf, high: float = np.inf) -> np.ndarray:
+    return (values < low) | (values > high)
+
+
+def spike_test(values: np.ndarray, threshold: float, window: int) -> np.ndarray:
+    return np.abs(values - rolling_median(values, window)) > threshold
+
+
+def gradient_test(values: np.ndarray, pressure: np.ndarray, threshold: float) -> np.ndarray:
+    """Flags values that changed more than threshold per db since the value above.
+    Pressure steps that aren't increasing (loops, upcast) are not tested."""
+    flags = np.zeros(len(values), dtype=bool)
+    dp = np.diff(pressure)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gradient = np.abs(np.diff(values) / dp)
+    flags[1:] = (dp > 0) & (gradient > threshold)
+    return flags
+
+
+def qc_table(table: stages.CnvData, config: dict) -> tuple[dict, dict]:
+    """Runs the configured tests. Returns the flags per FullName and a summary of the cast."""
+    extra = config.get('extra', dict())
+    bad_flag = table.bad_flag
+    data = dict()
+    short_names = dict()
+    for (short, long), column in zip(table.names(), table.columns):
+        values = np.asarray(column, dtype=float)
+        if bad_flag is not None:
+            values[values == bad_flag] = np.nan
+        data[long] = values
+        short_names[long] = short
+    pressure = data.get(extra.get('pressure', 'Pressure, Digiquartz [db]'))
+    window = int(extra.get('spike_window', 7))
+
+    flags = dict()
+    for name, tests in config.items():
+        if name in ('pairs', 'extra') or name not in data or not isinstance(tests, dict):
+            continue
+        values = data[name]
+        flag = np.zeros(len(values), dtype=np.uint8)
+        if 'min' in tests or 'max' in tests:
+            flag[range_test(values, tests.get('min', -np.inf), tests.get('max', np.inf))] |= RANGE
+        if 'spike' in tests:
+            flag[spike_test(values, tests['spike'], window)] |= SPIKE
+        if 'gradient' in tests and pressure is not None:
+            flag[gradient_test(values, pressure, tests['gradient'])] |= GRADIENT
+        flags[name] = flag
+
+    pairs = dict()
+    for pair in config.get('pairs', []):
+        primary, secondary = pair['primary'], pair['secondary']
+        if primary not in data or secondary not in data:
+            continue
+        difference = np.abs(data[primary] - data[secondary])
+        disagree = difference > pair['value']
+        for name in (primary, secondary):
+            flags.setdefault(name, np.zeros(len(difference), dtype=np.uint8))[disagree] |= PAIR
+        valid = difference[~np.isnan(difference)]
+        pairs[f'{short_names[primary]}-{short_names[secondary]}'] = {
+            'max_difference': float(valid.max()) if len(valid) else None,
+            'median_difference': float(np.median(valid)) if len(valid) else None,
+            'disagreeing': int(disagree.sum()),
+        }
+
+    summary = {
+        'bins': len(table.columns[0]) if table.columns else 0,
+        'flagged': {short_names[name]: {test: int(((flag & bit) > 0).sum()) for bit, test in FLAG_NAMES.items()}
+                    for name, flag in flags.items()},
+        'missing': {short_names[name]: int(np.isnan(data[name]).sum()) for name in flags},
+        'pairs': pairs,
+    }
+    summary['flagged_bins'] = int((np.bitwise_or.reduce(list(flags.values())) > 0).sum()) if flags else 0
+    return {short_names[name]: flag for name, flag in flags.items()}, summary
+
+
+def run_qc(cnv_file: Path, config: str = 'qc.yaml', qc_folder: Path | None = None) -> dict:
+    """QC of one processed cnv, writes the flags and the summary to qc_folder (default: qc next to the cnv)."""
+    cnv_file = Path(cnv_file)
+    qc_folder = Path(qc_folder or Path(cnv_file.parent, 'qc'))
+    if not qc_folder.is_dir():
+        qc_folder.mkdir(parents=True)
+    table = stages.CnvData.read(cnv_file)
+    config = load_config(config)
+    flags, summary = qc_table(table, config)
+    summary = {'cast': cnv_file.stem, **summary}
+
+    # The pressure as written in the cnv, so the flags can be matched to the data
+    keys = [range(summary['bins'])]
+    key_names = ['bin']
+    pressure = table.column_by_name(config.get('extra', dict()).get('pressure', 'Pressure, Digiquartz [db]'))
+    if pressure is not None:
+        # A cnv without data (e.g. the CTD never left the deck) has the names but no columns: 0 bins, nothing flagged
+        keys.append([(table.formats[pressure] if value != table.bad_flag else '{:.3e}').format(value).strip()
+                     for value in (table.columns[pressure] if summary['bins'] else [])])
+        key_names.append(table.names()[pressure][0])
+    with open(Path(qc_folder, f'{cnv_file.stem}_qc_flags.csv'), 'w', newline='') as flag_file:
+        writer = csv.writer(flag_file)
+        writer.writerow(key_names + [f'flag_{name}' for name in flags])
+        writer.writerows(zip(*keys, *(flag.tolist() for flag in flags.values())))
+    with open(Path(qc_folder, f'{cnv_file.stem}_qc.yaml'), 'w') as summary_file:
+        yaml.safe_dump(summary, summary_file, sort_keys=False)
+    return summary
+
+
+def run_qc_folder(folder: Path, config: str = 'qc.yaml') -> list[dict]:
+    """QC of all processed cnv of a cruise (the _u files of the bottles are skipped),
+    with one line per cast in qc/qc_summary.csv."""
+    folder = Path(folder)
+    summaries = [run_qc(cnv_file, config) for cnv_file in sorted(folder.glob('*.cnv'))
+                 if not cnv_file.stem.endswith('_u')]
+    if summaries:
+        with open(Path(folder, 'qc', 'qc_summary.csv'), 'w', newline='') as summary_file:
+            writer = csv.writer(summary_file)
+            writer.writerow(['cast', 'bins', 'flagged_bins'] + [f'{test}_flags' for test in FLAG_NAMES.values()])
+            for summary in summaries:
+                writer.writerow([summary['cast'], summary['bins'], summary['flagged_bins']] +
+                                [sum(counts[test] for counts in summary['flagged'].values())
+                                 for test in FLAG_NAMES.values()])
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('folder', help='Folder with the processed cnv files')
+    parser.add_argument('--config', default='qc.yaml', help='QC configuration in the config folder')
+    args = parser.parse_args(argv)
+    for summary in run_qc_folder(args.folder, args.config):
+        print(f"{summary['cast']}: {summary['flagged_bins']} of {summary['bins']} bins flagged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Smoke test of the work queue on one box: several local workers process made up casts with fake_sbebatch.py.
+
+    python smoke_work_queue.py --casts 40 --workers 4
+
+Checks that every cast is processed exactly once, that a broken cast fails without stopping the workers,
+that the cast of a dead worker is handed out again and that a worker that lost its lease can't write
+its result. Runs in a temporary folder (--keep to look at it afterwards).
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import work_queue
+
+HEX_HEADER = """* Sea-Bird SBE 9 Data File:
+* FileName = {name}
+* Software Version Seasave V 7.26.7.107
+* NMEA Latitude = 57 {minutes:05.2f} N
+* NMEA Longitude = 011 30.00 E
+* System UTC = May 17 2023 10:{minutes:02.0f}:11
+* SBE 11plus V 5.2
+*END*
+"""
+
+XMLCON = """<?xml version="1.0" encoding="UTF-8"?>
+<SBE_InstrumentConfiguration SB_ConfigCTD_FileVersion="7.26.7.0">
+  <Instrument>
+    <Name>SBE 911plus/917plus CTD</Name>
+    <SensorArray Size="3">
+      <Sensor index="0" SensorID="55"><TemperatureSensor SensorID="55"><SerialNumber>1</SerialNumber>
+        <CalibrationDate>01-Jan-23</CalibrationDate></TemperatureSensor></Sensor>
+      <Sensor index="1" SensorID="3"><ConductivitySensor SensorID="3"><SerialNumber>2</SerialNumber>
+        <CalibrationDate>01-Jan-23</CalibrationDate></ConductivitySensor></Sensor>
+      <Sensor index="2" SensorID="45"><PressureSensor SensorID="45"><SerialNumber>0934</SerialNumber>
+        <CalibrationDate>01-Jan-23</CalibrationDate></PressureSensor></Sensor>
+    </SensorArray>
+  </Instrument>
+</SBE_InstrumentConfiguration>
+"""
+
+
+def make_casts(folder: Path, count: int):
+    folder.mkdir(parents=True)
+    for i in range(count):
+        name = f'cast{i:03d}'
+        Path(folder, f'{name}.hex').write_text(HEX_HEADER.format(name=f'{name}.hex', minutes=i % 60)
+                                               + '0011223344556677\n' * 10)
+        Path(folder, f'{name}.xmlcon').write_text(XMLCON)
+    # No xmlcon, this one has to fail
+    Path(folder, 'broken.hex').write_text(HEX_HEADER.format(name='broken.hex', minutes=0))
+
+
+def worker(db_file: str) -> int:
+    return work_queue.run_worker(db_file, lease=30., heartbeat=0.2, output_folder='output', psa_folder='psa',
+                                 sbebatch=str(Path(__file__).with_name('fake_sbebatch.py').absolute()))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--casts', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--keep', action='store_true', help="Don't remove the temporary folder")
+    args = parser.parse_args(argv)
+
+    folder = Path(tempfile.mkdtemp(prefix='tunatools_smoke_'))
+    os.chdir(folder)
+    failures = []
+    try:
+        make_casts(Path(folder, 'raw'), args.casts)
+        queue = work_queue.WorkQueue('queue.sqlite')
+        hex_files = work_queue.tunatools.discover_casts('raw')
+        assert queue.add(hex_files) == args.casts + 1
+        assert queue.add(hex_files) == 0, 'casts were queued twice'
+
+        # A worker that lost its lease must not write its result
+        lease_queue = work_queue.WorkQueue('lease.sqlite')
+        lease_queue.add(hex_files[:1])
+        stale_id, _ = lease_queue.claim('stale', lease=-1.)
+        assert lease_queue.claim('current', lease=600.)[0] == stale_id, 'the expired lease was not handed out again'
+        assert not lease_queue.heartbeat(stale_id, 'stale', 600.)
+        assert not lease_queue.finish(stale_id, 'stale', work_queue.DONE), 'a stale worker wrote its result'
+        assert lease_queue.finish(stale_id, 'current', work_queue.DONE)
+
+        # The cast of a dead worker is processed by the others once its lease expired
+        queue.claim('dead', lease=-1.)
+
+        with multiprocessing.Pool(args.workers) as pool:
+            processed = pool.map(worker, [str(Path(folder, 'queue.sqlite'))] * args.workers)
+        status = queue.status()
+        print(f'{args.workers} workers processed {processed} casts: {status}')
+
+        if sum(processed) != args.casts + 1:
+            failures.append(f'{sum(processed)} jobs processed instead of {args.casts + 1}')
+        if status != {work_queue.DONE: args.casts, work_queue.FAILED: 1}:
+            failures.append(f'unexpected queue status {status}')
+        if [job[1] for job in queue.jobs(work_queue.FAILED)] != [str(Path('raw', 'broken.hex').absolute())]:
+            failures.append('the broken cast did not fail')
+        workers = {job[3] for job in queue.jobs(work_queue.DONE)}
+        if args.workers > 1 and len(workers) < 2:
+            failures.append(f'only {workers} did any work')
+        missing = [f'cast{i:03d}' for i in range(args.casts) if not Path('output', f'cast{i:03d}.cnv').is_file()]
+        if missing:
+            failures.append(f'no output for {missing}')
+        leftovers = [path for folder in ('output', 'psa', 'data') for path in Path(folder).rglob('.claims/*')]
+        if leftovers:
+            failures.append(f'staging folders were left behind: {leftovers}')
+        sharktools_files = [path for path in Path('data', 'select_this_one_for_sharktools').rglob('*.cnv')
+                            if '.claims' not in path.parts]
+        if len(sharktools_files) != args.casts:
+            failures.append(f'{len(sharktools_files)} SHARKtools files instead of {args.casts}')
+    finally:
+        os.chdir(Path(__file__).parent)
+        if args.keep:
+            print(f'Kept {folder}')
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+    for failure in failures:
+        print(f'FAILED: {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""Reading casts straight from compressed files and archives.
+
+Archived cruises are .zip/.tar/.tar.gz files or single .gz files. Instead of decompressing whole
+cruises to disk, every file of a cast is addressed by a plain path:
+ - /data/cruise.zip/cast1.hex is the member cast1.hex of the archive /data/cruise.zip
+ - /data/cast1.hex is read from /data/cast1.hex.gz if there is no /data/cast1.hex
+so with_suffix, stem and parent keep working. open_source streams the data, and on_disk extracts
+files only for as long as an external tool needs them.
+
+A compressed tar has no random access: every member read on its own decompresses the archive from the
+start up to it. Reading many members is done in one pass with stream_members, the xmlcon and bl streamed
+past are kept in memory, and no seekable handle is kept open. Processing a single cast still takes a few
+passes (header, xmlcon, extraction for SBE Data Processing), so a whole cruise costs time quadratic in its
+size: use .zip for cruises that are processed cast by cast, or extract the .tar.gz once.
+"""
+import contextlib
+import fnmatch
+import gzip
+import io
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path, PurePosixPath
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+COMPRESSED_TAR_SUFFIXES = ('.tar.gz', '.tgz')
+# xmlcon and bl members of compressed tars up to this size are kept in memory once read. Hex files are
+# not, they would pile up for the whole cruise.
+SMALL_MEMBER = 1 << 20
+SIDECAR_SUFFIXES = ('.xmlcon', '.bl')
+
+# archive -> ((mtime, size), ZipFile/TarFile or None for compressed tars, {member name: ZipInfo/TarInfo},
+#             {member name: content of small xmlcon/bl}), so every archive is indexed once
+_archives = dict()
+
+
+def is_archive(path: Path) -> bool:
+    return path.name.lower().endswith(ARCHIVE_SUFFIXES) and path.is_file()
+
+
+def open_archive(archive: Path):
+    """The opened archive (None for compressed tars) and its file members.
+    A compressed tar has no index, so it is streamed through once here to list its members."""
+    key = Path(archive).absolute()
+    stat = key.stat()
+    cached = _archives.get(key)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1], cached[2]
+    if key.name.lower().endswith('.zip'):
+        handle = zipfile.ZipFile(key)
+        members = {info.filename: info for info in handle.infolist() if not info.is_dir()}
+    elif key.name.lower().endswith(COMPRESSED_TAR_SUFFIXES):
+        handle = None
+        with tarfile.open(key, 'r|*') as tar:
+            members = {str(PurePosixPath(info.name)): info for info in tar if info.isfile()}
+    else:
+        handle = tarfile.open(key)
+        members = {str(PurePosixPath(info.name)): info for info in handle.getmembers() if info.isfile()}
+    _archives[key] = ((stat.st_mtime_ns, stat.st_size), handle, members, dict())
+    return handle, members
+
+
+class StreamedMember(io.RawIOBase):
+    """A member of a compressed tar, read while the archive is decompressed. Closing it closes the archive."""
+    def __init__(self, tar: tarfile.TarFile, info: tarfile.TarInfo):
+        self.tar = tar
+        self.member = tar.extractfile(info)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.member.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.tar.close()
+        super().close()
+
+
+def is_sidecar(info: tarfile.TarInfo) -> bool:
+    return info.size <= SMALL_MEMBER and PurePosixPath(info.name).suffix.lower() in SIDECAR_SUFFIXES
+
+
+def open_streamed(archive: Path, member: str):
+    """A member of a compressed tar for reading once from start to end. The xmlcon and bl passed on the way
+    are kept, so they don't cost another pass."""
+    key = Path(archive).absolute()
+    open_archive(key)
+    small = _archives[key][3]
+    if member in small:
+        return io.BytesIO(small[member])
+    tar = tarfile.open(key, 'r|*')
+    for info in tar:
+        name = str(PurePosixPath(info.name))
+        if name == member:
+            if is_sidecar(info):
+                small[name] = tar.extractfile(info).read()
+                tar.close()
+                return io.BytesIO(small[name])
+            return io.BufferedReader(StreamedMember(tar, info))
+        if info.isfile() and is_sidecar(info):
+            small[name] = tar.extractfile(info).read()
+    tar.close()
+    raise FileNotFoundError(f"{member} is not in {archive}")
+
+
+def stream_members(archive: Path, names=None):
+    """Yields (member name, opened file) of the members (all files if names is None) in the order they are
+    stored, reading the archive once. Each file is only valid until the next one is yielded."""
+    handle, members = open_archive(archive)
+    if isinstance(handle, zipfile.ZipFile):
+        for name in members:
+            if names is None or name in names:
+                with handle.open(name) as opened_member:
+                    yield name, opened_member
+        return
+    with tarfile.open(Path(archive).absolute(), 'r|*') as tar:
+        for info in tar:
+            name = str(PurePosixPath(info.name))
+            if info.isfile() and (names is None or name in names):
+                yield name, tar.extractfile(info)
+
+
+def locate(path: Path):
+    """Where the data of the path is: ('file', path, None), ('gzip', gz file, None),
+    ('archive', archive, member) or None if it doesn't exist."""
+    path = Path(path)
+    if path.is_file():
+        return 'file', path, None
+    gz = path.with_name(path.name + '.gz')
+    if gz.is_file():
+        return 'gzip', gz, None
+    for archive in path.parents:
+        if is_archive(archive):
+            member = path.relative_to(archive).as_posix()
+            if member in open_archive(archive)[1]:
+                return 'archive', archive, member
+            return None
+    return None
+
+
+def exists(path: Path) -> bool:
+    return locate(path) is not None
+
+
+def open_source(path: Path, mode: str = 'r'):
+    """Opens a plain file, a .gz or an archive member for streaming, mode is 'r' or 'rb'."""
+    location = locate(path)
+    if not location:
+        raise FileNotFoundError(f"{path} is neither a file, nor a .gz nor in an archive")
+    kind, real, member = location
+    if kind == 'file':
+        return open(real, mode)
+    if kind == 'gzip':
+        return gzip.open(real, 'rb' if 'b' in mode else 'rt')
+    handle, members = open_archive(real)
+    if isinstance(handle, zipfile.ZipFile):
+        raw = handle.open(member)
+    elif handle is None:
+        raw = open_streamed(real, member)
+    else:
+        raw = handle.extractfile(members[member])
+    return raw if 'b' in mode else io.TextIOWrapper(raw)
+
+
+def state(path: Path):
+    """(size, mtime) to notice changed files, None if the path doesn't exist.
+    Archive members have the size of the member and the mtime of the archive."""
+    location = locate(path)
+    if not location:
+        return None
+    kind, real, member = location
+    stat = real.stat()
+    if kind == 'archive':
+        info = open_archive(real)[1][member]
+        return (info.file_size if isinstance(info, zipfile.ZipInfo) else info.size), stat.st_mtime_ns
+    return stat.st_size, stat.st_mtime_ns
+
+
+def disk_folder(path: Path) -> Path:
+    """The closest real folder of the path, where files belonging to it (shadow files) can be written."""
+    for folder in Path(path).parents:
+        if folder.is_dir():
+            return folder
+    return Path('.')
+
+
+def archive_members(archive: Path, pattern: str = '*') -> list[Path]:
+    """Paths of all members of the archive whose name matches the pattern."""
+    return sorted(Path(archive, member) for member in open_archive(archive)[1]
+                  if fnmatch.fnmatch(PurePosixPath(member).name, pattern))
+
+
+def list_sources(folder: Path, pattern: str = '*') -> list[Path]:
+    """Like folder.glob(pattern), also for folders in an archive. x.gz files are listed as x."""
+    folder = Path(folder)
+    if folder.is_dir():
+        found = set()
+        for path in folder.iterdir():
+            if not path.is_file():
+                continue
+            if path.name.endswith('.gz') and not is_archive(path):
+                path = path.with_name(path.name[:-3])
+            if fnmatch.fnmatch(path.name, pattern):
+                found.add(path)
+        return sorted(found)
+    for archive in [folder] + list(folder.parents):
+        if is_archive(archive):
+            return [member for member in archive_members(archive, pattern) if member.parent == folder]
+    return []
+
+
+@contextlib.contextmanager
+def on_disk(paths: list[Path], scratch_folder: Path | None = None):
+    """Yields the paths as real files. If one of them is compressed or in an archive, all existing ones are
+    extracted with their names into a temporary folder, so they stay next to each other, and removed afterwards.
+    Members of the same archive are extracted in one pass."""
+    locations = [locate(path) if path else None for path in paths]
+    if all(location is None or location[0] == 'file' for location in locations):
+        yield list(paths)
+        return
+    scratch = Path(tempfile.mkdtemp(prefix='tunatools_', dir=scratch_folder))
+    try:
+        real_paths = []
+        # archive -> {member: where it is extracted to}
+        in_archives = dict()
+        for path, location in zip(paths, locations):
+            if location is None:
+                real_paths.append(path)
+                continue
+            real_path = Path(scratch, path.name)
+            real_paths.append(real_path)
+            if location[0] == 'archive':
+                in_archives.setdefault(location[1], dict())[location[2]] = real_path
+                continue
+            with open_source(path, 'rb') as source, open(real_path, 'wb') as extracted:
+                shutil.copyfileobj(source, extracted)
+        for archive, targets in in_archives.items():
+            for member, source in stream_members(archive, set(targets)):
+                with open(targets[member], 'wb') as extracted:
+                    shutil.copyfileobj(source, extracted)
+        yield real_paths
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,258 @@
+"""Execution backends for the stages of a batch (datcnv, filter, alignctd, celltm, loopedit, derive, binavg, bottlesum).
+
+Every stage in psa_dict can be routed to a different backend:
+ - SBEBatchBackend runs the stage with sbebatch.exe (the reference)
+ - NativeBackend runs the stage in-process, see native_stages for the implemented ones
+ - StubBackend copies outputs recorded from an earlier run, for tests without SBE Data Processing
+
+Data is passed between stages in the cheapest form available: consecutive external stages share one
+sbebatch call, consecutive native stages pass the table in memory and the cnv is only written when
+a stage needs the file (or at the end).
+"""
+import datetime
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+# The file a stage writes and the file it reads, relative to output_folder/{stem}{append}
+OUTPUT_SUFFIX = {'bottlesum': '.btl'}
+INPUT_SUFFIX = {'bottlesum': '.ros'}
+
+
+def stage_output(measurement, name: str, append: str = '') -> Path:
+    return Path(measurement.output_folder, measurement.hex.stem + append).with_suffix(OUTPUT_SUFFIX.get(name, '.cnv'))
+
+
+def stage_input(measurement, name: str, append: str = '') -> Path:
+    if name == 'datcnv':
+        return measurement.hex
+    return Path(measurement.output_folder, measurement.hex.stem + append).with_suffix(INPUT_SUFFIX.get(name, '.cnv'))
+
+
+class CnvData:
+    """A cnv file in memory: the header lines (up to *END*) and the data as one list per column."""
+    def __init__(self, header: list[str], columns: list[list[float]], formats: list[str]):
+        self.header = header
+        self.columns = columns
+        # Per column, the format the values were written in, so writing the file back keeps the precision
+        self.formats = formats
+
+    @classmethod
+    def read(cls, path: Path) -> 'CnvData':
+        header = []
+        rows = []
+        with open(path, 'r', errors='replace') as cnv_file:
+            for line in cnv_file:
+                header.append(line.rstrip('\n'))
+                if line.startswith('*END*'):
+                    break
+            for line in cnv_file:
+                if line.strip():
+                    rows.append(line.split())
+        columns = [list(map(float, column)) for column in zip(*rows)]
+        table = cls(header, columns, [])
+        # Bad flags are always written as -9.990e-29, they don't tell how the column is formatted
+        bad_flag = table.bad_flag
+        table.formats = [cls.value_format(next((value for value in column if float(value) != bad_flag), column[0]))
+                         for column in zip(*rows)]
+        return table
+
+    @staticmethod
+    def value_format(value: str) -> str:
+        mantissa = value.lower().split('e')[0]
+        decimals = len(mantissa.split('.')[1]) if '.' in mantissa else 0
+        return f'{{:11.{decimals}{"e" if "e" in value.lower() else "f"}}}'
+
+    def write(self, path: Path):
+        bad_flag = self.bad_flag
+        with open(path, 'w') as cnv_file:
+            cnv_file.write('\n'.join(self.header) + '\n')
+            for row in zip(*self.columns):
+                cnv_file.write(''.join((f if value != bad_flag else '{:11.3e}').format(value)
+                                       for f, value in zip(self.formats, row)) + '\n')
+
+    def header_value(self, key: str) -> str:
+        """The value of a '# key = value' header line, None if there is none."""
+        for line in self.header:
+            if line.startswith('# ') and '=' in line:
+                name, value = line[2:].split('=', 1)
+                if name.strip() == key:
+                    return value.strip()
+        return None
+
+    def names(self) -> list[tuple[str, str]]:
+        """(short name, long name) per column, e.g. ('t090C', 'Temperature [ITS-90, deg C]')"""
+        names = []
+        for line in self.header:
+            if line.startswith('# name '):
+                short, _, long = line.split('=', 1)[1].strip().partition(': ')
+                names.append((short, long))
+        return names
+
+    def column_by_name(self, full_name: str) -> int:
+        """Index of the column whose long name is the FullName used in the psa files, None if missing."""
+        for i, (_, long) in enumerate(self.names()):
+            if long == full_name:
+                return i
+        return None
+
+    @property
+    def interval(self) -> float:
+        """Seconds between scans (# interval = seconds: 0.0416667)"""
+        return float(self.header_value('interval').split(':')[1])
+
+    @property
+    def bad_flag(self) -> float:
+        bad_flag = self.header_value('bad_flag')
+        return float(bad_flag) if bad_flag else None
+
+    def add_header_lines(self, lines: list[str]):
+        """Adds processing notes before the *END* like SBE Data Processing does."""
+        self.header[-1:-1] = lines
+
+
+class StageData:
+    """What is passed between stages: a file and, if a native stage produced it, the table in memory.
+    Native stages read the table, external ones the file, each is only created when needed."""
+    def __init__(self, path: Path, table: CnvData | None = None):
+        self.path = Path(path)
+        self.table = table
+        # A table coming from a native stage hasn't been written yet
+        self.on_disk = table is None
+
+    def load(self) -> CnvData:
+        if self.table is None:
+            self.table = CnvData.read(self.path)
+        return self.table
+
+    def to_disk(self) -> Path:
+        if not self.on_disk:
+            self.table.write(self.path)
+            self.on_disk = True
+        return self.path
+
+
+class StageBackend:
+    """Runs stages of a batch. run gets consecutive stages routed to this backend as (name, psa) and
+    the output of the stage before, and returns the output of its last stage."""
+    # True if the backend works on the table in memory, else the data is written to disk before run
+    in_memory = False
+
+    def supports(self, name: str) -> bool:
+        """False if the backend can't run the stage, checked before any stage runs."""
+        return True
+
+    def run(self, measurement, stages: list[tuple[str, Path]], data: StageData, append: str = '') -> StageData:
+        raise NotImplementedError
+
+
+class SBEBatchBackend(StageBackend):
+    """Runs the stages with SBE Data Processing, all of them in one sbebatch call."""
+    def run(self, measurement, stages, data, append=''):
+        batch_name = Path(measurement.psa_folder, f'batch_{measurement.hex.stem}{append}_{stages[0][0]}.txt')
+        with open(batch_name, 'w') as sbe_params:
+            for name, file in stages:
+                sbe_params.write(measurement.batch_line(name, file, append))
+        subprocess.run([measurement.sbebatch, batch_name, measurement.output_folder], check=True)
+        return StageData(stage_output(measurement, stages[-1][0], append))
+
+
+def low_pass(values: list[float], time_constant: float, interval: float, bad_flag: float) -> list[float]:
+    """The SBE Data Processing low pass filter, run forward and backward so there is no phase shift.
+    Bad values are passed through and skipped by the filter."""
+    gamma = 2 * time_constant / interval
+    a = 1 / (1 + gamma)
+    b = a * (1 - gamma)
+    result = list(values)
+    for order in (range(len(result)), range(len(result) - 1, -1, -1)):
+        x_prev = y_prev = None
+        for i in order:
+            x = result[i]
+            if x == bad_flag:
+                continue
+            if y_prev is None:
+                y = x
+            else:
+                y = a * (x + x_prev) - b * y_prev
+            x_prev, y_prev = x, y
+            result[i] = y
+    return result
+
+
+def native_filter(measurement, psa: Path, table: CnvData) -> CnvData:
+    """Filter: low pass filter A or B per FullName as set in the FilterTypeArray of the psa."""
+    root = ET.parse(psa).getroot()
+    full_names = {item.get('index'): item.find('.//FullName').get('value')
+                  for item in root.findall('.//CalcArrayItem')}
+    time_constants = {1: float(root.find('TimeConstFilterA').get('value')),
+                      2: float(root.find('TimeConstFilterB').get('value'))}
+    filtered = {1: [], 2: []}
+    for item in root.findall('FilterTypeArray/ArrayItem'):
+        filter_type = int(item.get('value'))
+        column = table.column_by_name(full_names.get(item.get('index')))
+        if filter_type not in time_constants or column is None:
+            continue
+        table.columns[column] = low_pass(table.columns[column], time_constants[filter_type],
+                                         table.interval, table.bad_flag)
+        filtered[filter_type].append(table.names()[column][0])
+    table.add_header_lines(
+        [f'# filter_date = {datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")}, tunatools native',
+         f'# filter_in = {psa}',
+         f'# filter_low_pass_tc_A = {time_constants[1]:.3f}',
+         f'# filter_low_pass_tc_B = {time_constants[2]:.3f}',
+         f'# filter_low_pass_A_vars = {" ".join(filtered[1])}',
+         f'# filter_low_pass_B_vars = {" ".join(filtered[2])}'])
+    return table
+
+
+# Stage name -> function(measurement, psa, table) -> table. Add stages here as they are ported.
+native_stages = {
+    'filter': native_filter,
+}
+
+
+class NativeBackend(StageBackend):
+    """Runs the stages in-process on the table in memory."""
+    in_memory = True
+
+    def supports(self, name):
+        return name in native_stages
+
+    def run(self, measurement, stages, data, append=''):
+        for name, psa in stages:
+            table = native_stages[name](measurement, psa, data.load())
+            data = StageData(stage_output(measurement, name, append), table)
+        return data
+
+
+class StubBackend(StageBackend):
+    """Copies outputs recorded with record_folder from an earlier run, stage by stage.
+    The recordings are expected in recordings/{stage}/{output file name}."""
+    def __init__(self, recordings: Path):
+        self.recordings = Path(recordings)
+
+    def run(self, measurement, stages, data, append=''):
+        for name, _ in stages:
+            output = stage_output(measurement, name, append)
+            recorded = Path(self.recordings, name, output.name)
+            if not recorded.is_file():
+                raise FileNotFoundError(f"There is no recorded output of {name} for {measurement.hex.stem} in {self.recordings}")
+            shutil.copyfile(recorded, output)
+            # datcnv may also create the .ros for the bottle summary
+            recorded_ros = recorded.with_suffix('.ros')
+            if name == 'datcnv' and recorded_ros.is_file():
+                shutil.copyfile(recorded_ros, output.with_suffix('.ros'))
+            data = StageData(output)
+        return data
+
+
+def record_stage(name: str, data: StageData, record_folder: Path):
+    """Keeps a copy of a stage output so StubBackend can replay it."""
+    folder = Path(record_folder, name)
+    if not folder.is_dir():
+        folder.mkdir(parents=True)
+    path = data.to_disk()
+    shutil.copyfile(path, Path(folder, path.name))
+    if name == 'datcnv' and path.with_suffix('.ros').is_file():
+        shutil.copyfile(path.with_suffix('.ros'), Path(folder, path.with_suffix('.ros').name))
@@ -1,4 +1,9 @@
+import bisect
+import contextlib
+import csv
 import datetime
+import functools
+import hashlib
 import os
 import yaml
 import re
@@ -8,6 +13,12 @@ import warnings
 import subprocess
 import shutil
 import sys
+import threading
+import time
+import dateutil.parser
+
+import sources
+import stages
 
 
 def get_base_path() -> Path:
@@ -59,13 +70,18 @@ def createCalcArrayItem(calc_array, sensor_dependant_items, amount=1, index=0):
     return calc_items
 
 
+def sensor_inventory(xmlcon_str: ET) -> list[str]:
+    """The sensor types of the xmlcon, once per channel they are used in (NotInUse included)."""
+    return [s.tag for s in xmlcon_str.findall('.//Sensor/*')]
+
+
 def build_CalcArray(xmlcon_str: ET, defaults, extras, ignore_ids: list[int], ignore_sensors: list[str]):
     """Builds the complete CalcArray based on the provided xmlcon.
     defaults is a list of the measurements we will always have: pump status, scan count, etc.
     extras is a list of the """
     calc_array = ET.Element('CalcArray')
     index = 0
-    sensor_types = [s.tag for s in xmlcon_str.findall('.//Sensor/*')]
+    sensor_types = sensor_inventory(xmlcon_str)
     for default in defaults:
         # Filters and so on don't need these in their processing
         if default['UnitID'] in ignore_ids:
@@ -85,7 +101,8 @@ def build_CalcArray(xmlcon_str: ET, defaults, extras, ignore_ids: list[int], ign
 def calcArray_from_xmlcon(xmlcon_file: Path, ignore_ids=[-1], ignore_sensors: list[str] = [],
                           default: str | None = "CalcArray_default.yaml",
                           optional: str | None = "CalcArray_optional.yaml"):
-    xmlcon_xml = ET.parse(xmlcon_file).getroot()
+    with sources.open_source(xmlcon_file, 'rb') as opened_xmlcon_file:
+        xmlcon_xml = ET.parse(opened_xmlcon_file).getroot()
     base_path = get_base_path()
     if default:
         with open(Path(base_path, 'config', default)) as yaml_file:
@@ -140,12 +157,298 @@ def is_windows_path(obj) -> bool:
 def valid_bl_file(path: Path) -> bool:
     """Seasave may produce a .bl file with no data. As this would result in no .ros file, bottlesummary will fail.
     Thus, we should remove the bottle file if it is 'empty'"""
-    with open(path, 'r') as bottle_file:
-        # The file has 2 header lines and an ending new line
-        if len(bottle_file.readlines()) < 4:
-            return False
+    with sources.open_source(path, 'rb') as bottle_file:
+        return valid_bl_content(bottle_file.read())
+
+
+def valid_bl_content(content: bytes) -> bool:
+    """valid_bl_file for a bl that was already read"""
+    # The file has 2 header lines and an ending new line
+    if len(content.splitlines()) < 4:
+        return False
+    else:
+        return True
+
+
+def discover_casts(folder: Path, recursive: bool = False) -> list[Path]:
+    """All hex files in the folder, sorted so every caller sees the casts in the same order.
+    Each one is expected to have a xmlcon (and maybe a bl) with the same stem next to it.
+    Compressed hex files (.hex.gz) and hex files in archives (.zip, .tar.gz) are found as well,
+    see sources for how their paths look. The folder may be an archive itself."""
+    folder = Path(folder)
+    if sources.is_archive(folder):
+        return sources.archive_members(folder, '*.hex')
+    folders = [folder] + (sorted(path for path in folder.rglob('*') if path.is_dir()) if recursive else [])
+    hex_files = []
+    for subfolder in folders:
+        hex_files += sources.list_sources(subfolder, '*.hex')
+        for archive in sorted(subfolder.iterdir()):
+            if sources.is_archive(archive):
+                hex_files += sources.archive_members(archive, '*.hex')
+    # Shadow files are our own copies of the hex files, not casts of their own
+    return sorted(hex_file for hex_file in hex_files if hex_file.parent.name != 'shadow')
+
+
+def read_hex_header(path: Path) -> str:
+    """Reads the header of a hex file (everything up to and including *END*).
+    NMEA coordinates and the System UTC live there, so there is no need to read (or decompress) the scans.
+    The header is read once as long as the file doesn't change, it is asked for by every psa."""
+    return _read_hex_header(Path(path).absolute(), sources.state(path))
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_hex_header(path: Path, state) -> str:
+    header = []
+    with sources.open_source(path, 'r') as opened_hex_file:
+        for line in opened_hex_file:
+            header.append(line)
+            if line.startswith('*END*'):
+                break
+    return ''.join(header)
+
+
+def parse_header_lat_lon(hex_header: str) -> (float, float):
+    """Parses the NMEA coordinates Seasave writes to the header from degrees
+    and decimal minutes (DD) to degrees. None if there are none."""
+    lat = re.search(r'^\* NMEA Latitude = (\d{2}) ([\d\.]+) (\w)$',
+                    hex_header, re.M)
+    lon = re.search(r'^\* NMEA Longitude = (\d{3}) ([\d\.]+) (\w)$',
+                    hex_header, re.M)
+    if not lat or not lon:
+        return None
+    d, m, SN = lat.groups()
+    lat_DD = (-1 if SN == "S" else 1) * (int(d) + float(m) / 60.)
+    d, m, EW = lon.groups()
+    lon_DD = (-1 if EW == "W" else 1) * (int(d) + float(m) / 60.)
+    return lat_DD, lon_DD
+
+
+def format_nmea_header(lat: float, lon: float) -> str:
+    """The NMEA header lines like Seasave writes them (degrees and decimal minutes), see parse_header_lat_lon."""
+    lines = []
+    for name, value, width, hemispheres in (('Latitude', lat, 2, 'NS'), ('Longitude', lon, 3, 'EW')):
+        # Rounded first, so 59.999 minutes become the next degree instead of 60.00
+        degrees, minutes = divmod(round(abs(value) * 60, 2), 60)
+        lines.append(f'* NMEA {name} = {int(degrees):0{width}d} {minutes:05.2f} {hemispheres[value < 0]}\n')
+    return ''.join(lines)
+
+
+def parse_header_system_utc(hex_header: str) -> datetime.datetime:
+    """Start of the measurement as written by Seasave in the header (* System UTC = May 17 2023 10:50:11)."""
+    date = re.search(r'^\* System UTC = ([\w \d:]*)$', hex_header, re.M)
+    if not date:
+        return None
+    return datetime.datetime.strptime(date[1], '%b %d %Y %H:%M:%S')
+
+
+def parse_nmea_coordinate(value: str, hemisphere: str) -> float:
+    """Converts a NMEA sentence coordinate (dddmm.mmmm) to degrees."""
+    degrees, minutes = divmod(float(value), 100)
+    return (-1 if hemisphere in ('S', 'W') else 1) * (degrees + minutes / 60.)
+
+
+class CoordinateProvider:
+    """Supplies coordinates for a measurement whose hex file has no NMEA position.
+    Subclasses implement get_coords and return (lat, lon) in degrees or None."""
+    def get_coords(self, measurement) -> (float, float):
+        raise NotImplementedError
+
+
+class StationLogCoordinates(CoordinateProvider):
+    """Coordinates from a station log CSV with one row per cast, keyed by the stem of the hex file.
+    The CSV is read once, so looking up a cast is a dict access."""
+    def __init__(self, csv_file: Path, key_column: str = 'cast',
+                 lat_column: str = 'lat', lon_column: str = 'lon'):
+        self.coords = dict()
+        with open(csv_file, 'r', newline='') as opened_csv_file:
+            for row in csv.DictReader(opened_csv_file):
+                try:
+                    self.coords[row[key_column].strip()] = (float(row[lat_column]), float(row[lon_column]))
+                except ValueError:
+                    # Empty or broken cells, this cast will have to get its coordinates elsewhere
+                    continue
+
+    def get_coords(self, measurement) -> (float, float):
+        return self.coords.get(measurement.hex.stem)
+
+
+class NMEATrackCoordinates(CoordinateProvider):
+    """Coordinates from the ship's track, either a NMEA log ($--RMC sentences) or a CSV with
+    ISO time, lat, lon per line. The track is sorted once and every cast is looked up by its
+    System UTC with a binary search, interpolating between the two surrounding fixes."""
+    def __init__(self, track_file: Path, max_gap: float = 600.):
+        # max_gap: seconds between fixes (or to the cast) after which we don't trust the track
+        self.max_gap = max_gap
+        fixes = []
+        with open(track_file, 'r', errors='replace') as opened_track_file:
+            for line in opened_track_file:
+                fix = self.parse_line(line)
+                if fix:
+                    fixes.append(fix)
+        fixes.sort()
+        self.times = [fix[0] for fix in fixes]
+        self.lats = [fix[1] for fix in fixes]
+        self.lons = [fix[2] for fix in fixes]
+
+    @staticmethod
+    def parse_line(line: str):
+        """Returns (timestamp, lat, lon) or None if the line is no usable fix."""
+        rmc = re.search(r'\$\w\wRMC,([^*]*)', line)
+        if rmc:
+            fields = rmc[1].split(',')
+            # hhmmss.ss, status, lat, N/S, lon, E/W, speed, course, ddmmyy
+            if len(fields) < 9 or fields[1] != 'A' or not fields[2] or not fields[4]:
+                return None
+            try:
+                time = datetime.datetime.strptime(fields[8] + fields[0].split('.')[0], '%d%m%y%H%M%S')
+                lat = parse_nmea_coordinate(fields[2], fields[3])
+                lon = parse_nmea_coordinate(fields[4], fields[5])
+            except ValueError:
+                return None
         else:
-            return True
+            fields = line.strip().split(',')
+            if len(fields) < 3:
+                return None
+            try:
+                time = datetime.datetime.fromisoformat(fields[0].strip())
+                lat, lon = float(fields[1]), float(fields[2])
+            except ValueError:
+                # Most likely a header line
+                return None
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=datetime.timezone.utc)
+        return time.timestamp(), lat, lon
+
+    def get_coords(self, measurement) -> (float, float):
+        start = measurement.parse_system_utc()
+        if not start or not self.times:
+            return None
+        t = start.replace(tzinfo=datetime.timezone.utc).timestamp()
+        i = bisect.bisect_left(self.times, t)
+        if i < len(self.times) and self.times[i] == t:
+            return self.lats[i], self.lons[i]
+        if i == 0 or i == len(self.times):
+            # The cast is before or after the track
+            return None
+        t0, t1 = self.times[i - 1], self.times[i]
+        if t1 - t0 > self.max_gap:
+            return None
+        w = (t - t0) / (t1 - t0)
+        lat = self.lats[i - 1] + w * (self.lats[i] - self.lats[i - 1])
+        # Don't interpolate the long way around when crossing the antimeridian
+        dlon = (self.lons[i] - self.lons[i - 1] + 180.) % 360. - 180.
+        lon = (self.lons[i - 1] + w * dlon + 180.) % 360. - 180.
+        return lat, lon
+
+
+@functools.lru_cache(maxsize=None)
+def load_coordinate_providers(config: str = 'expedition_specific.yaml') -> tuple:
+    """Builds the coordinate providers configured for the expedition (station_log, nmea_track).
+    This is cached, so the station log and track are only parsed once per run and not per cast."""
+    with open(Path(get_base_path(), 'config', config), 'r') as yaml_file:
+        extra_data = yaml.safe_load(yaml_file) or dict()
+    providers = []
+    station_log = extra_data.get('station_log')
+    if station_log:
+        if isinstance(station_log, str):
+            station_log = {'file': station_log}
+        providers.append(StationLogCoordinates(Path(station_log.pop('file')), **station_log))
+    nmea_track = extra_data.get('nmea_track')
+    if nmea_track:
+        if isinstance(nmea_track, str):
+            nmea_track = {'file': nmea_track}
+        providers.append(NMEATrackCoordinates(Path(nmea_track.pop('file')), **nmea_track))
+    return tuple(providers)
+
+# SHARKtools only understands calibration dates in these formats
+SHARKTOOLS_DATE_FORMATS = [
+    '%d%m%y',
+    '%d%m%Y',
+    '%d-%b-%y',
+    '%d-%b-%Y',
+    '%d %b %y',
+    '%d %b %Y'
+]
+
+
+@functools.lru_cache(maxsize=None)
+def normalize_calibration_date(date: str) -> str:
+    """Returns the date unchanged if SHARKtools understands it, else the date reformatted.
+    If not even dateutil knows what the date says it is removed. A cruise has only a handful of
+    distinct dates, so the result is memoized per date string."""
+    for date_format in SHARKTOOLS_DATE_FORMATS:
+        try:
+            datetime.datetime.strptime(date, date_format)
+        except ValueError:
+            # try the next format if this one doesn't work
+            continue
+        return date
+    try:
+        # You can pick any of the formats. This is personal preference
+        return dateutil.parser.parse(date).strftime(SHARKTOOLS_DATE_FORMATS[3])
+    except (dateutil.parser.ParserError, OverflowError):
+        return ''
+
+
+class XmlconNormalizer:
+    """Creates shadow xmlcon files with calibration dates SHARKtools understands.
+    Shadow files are stored under the hash of the original content, so a cruise where every cast
+    shares the same xmlcon gets one shadow file, and identical inputs are only normalized once."""
+    def __init__(self):
+        # (path, (size, mtime)) -> content hash, spares reading unchanged files
+        self.hashes = dict()
+        # (content hash, shadow folder) -> the shadow file, None if the content needs no changes
+        self.normalized = dict()
+
+    def content_hash(self, xmlcon: Path) -> str:
+        key = (xmlcon.absolute(), sources.state(xmlcon))
+        if key not in self.hashes:
+            with sources.open_source(xmlcon, 'rb') as opened_xmlcon_file:
+                self.hashes[key] = hashlib.sha1(opened_xmlcon_file.read()).hexdigest()
+        return self.hashes[key]
+
+    def normalize(self, xmlcon: Path, shadow_folder: Path | None = None) -> Path:
+        """Returns the xmlcon itself if all dates are fine, else the (possibly already existing) shadow file."""
+        if shadow_folder is None:
+            shadow_folder = Path(sources.disk_folder(xmlcon), 'shadow')
+        shadow_folder = Path(shadow_folder)
+        digest = self.content_hash(xmlcon)
+        key = (digest, shadow_folder.absolute())
+        if key in self.normalized:
+            # Only the shadow file is shared, an unchanged xmlcon stays the one of the cast
+            return self.normalized[key] or xmlcon
+
+        with sources.open_source(xmlcon, 'r') as opened_xmlcon_file:
+            xmlcon_content = opened_xmlcon_file.read()
+        # We keep the file intact if every date would be understood, else we would get a ton of shadow files
+        normalized_content = re.sub(
+            r'<CalibrationDate>(.*?)</CalibrationDate>',
+            lambda date: f'<CalibrationDate>{normalize_calibration_date(date[1]) if date[1] else ""}</CalibrationDate>',
+            xmlcon_content)
+        if normalized_content == xmlcon_content:
+            self.normalized[key] = None
+            return xmlcon
+        result = Path(shadow_folder, f'{digest}.xmlcon')
+        if not shadow_folder.is_dir():
+            os.makedirs(shadow_folder, exist_ok=True)
+        old_content = None
+        if result.is_file():
+            with open(result, 'r') as opened_xmlcon_file:
+                old_content = opened_xmlcon_file.read()
+        if old_content != normalized_content:
+            # Other workers may be reading the shadow file right now, so it is written aside and
+            # replaced in one step instead of being truncated under them
+            temporary = Path(shadow_folder, f'.{digest}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(temporary, 'w') as opened_xmlcon_file:
+                opened_xmlcon_file.write(normalized_content)
+            os.replace(temporary, result)
+        self.normalized[key] = result
+        return result
+
+
+# Shared by all measurements of a run
+xmlcon_normalizer = XmlconNormalizer()
+
 
 class SBE911_Measurement:
     def __init__(self, *args, **kwargs):
@@ -158,11 +461,41 @@ class SBE911_Measurement:
         self.xmlcon = None
         self.hex = None
         self.psa_dict = dict()
+        # Everything run by just_do_stuff, psa_dict only holds the last batch
+        self.processed_psa = dict()
+        # Seconds per step of just_do_stuff
+        self.stage_durations = dict()
+        # Result of run_qc
+        self.qc_summary = None
+        # Files just_do_stuff wrote outside the stage outputs (SHARKtools copy, QC), tracked by the cast index
+        self.products = []
+
+        # Asked in order for coordinates if the hex file has none, see parse_lat_lon
+        self.coordinate_providers = kwargs.get('coordinate_providers')
+        if self.coordinate_providers is None:
+            self.coordinate_providers = load_coordinate_providers()
 
         self.source_folder = Path(kwargs.get('source_folder', 'data/raw'))
         self.output_folder = Path(kwargs.get('output_folder', 'data/output'))
         self.psa_folder = Path(kwargs.get('psa_folder', 'data/psa_files'))
         self.generic_psa_folder = Path(kwargs.get('generic_psa_folder', 'config/generic_psa_files'))
+        # Can be swapped for a stand-in when testing without SBE Data Processing
+        self.sbebatch = kwargs.get('sbebatch', 'sbebatch.exe')
+        # Archive members and .gz files are extracted here while external tools need them (None: system temp)
+        self.scratch_folder = kwargs.get('scratch_folder')
+        # Stage name -> stages.StageBackend, stages not in here run on default_backend
+        self.backends = kwargs.get('backends', dict())
+        self.default_backend = kwargs.get('default_backend', stages.SBEBatchBackend())
+        for name, backend in self.backends.items():
+            if not backend.supports(name):
+                raise NotImplementedError(f"{type(backend).__name__} can't run {name}")
+        # Keeps the output of every stage in record_folder/{stage}/, to be replayed with stages.StubBackend
+        self.record_folder = kwargs.get('record_folder')
+        self.batch_append = ''
+        # True while sources_on_disk has extracted the sources to a scratch folder
+        self.sources_extracted = False
+        # Convert the hex once and derive downcast and bottle products from it, instead of converting twice
+        self.single_conversion = kwargs.get('single_conversion', False)
 
         # Make everything absolute paths
         for folder in ['source_folder', 'psa_folder', 'output_folder']:
@@ -184,7 +517,7 @@ class SBE911_Measurement:
             if is_windows_path(args):
                 if args.is_absolute():
                     self.source_folder = args.parent
-                args = list(self.source_folder.glob(f'{args.stem}.*'))
+                args = sources.list_sources(self.source_folder, f'{args.stem}.*')
                 args = [arg.absolute() for arg in args]
 
         # [AOM23-station-04-cast1.xmlcon, AOM23-station-04-cast1.hex, ...]
@@ -229,24 +562,32 @@ class SBE911_Measurement:
             if getattr(self, file) and not getattr(self, file).is_absolute():
                 setattr(self, file, Path(self.source_folder, getattr(self, file)))
 
+        # SHARKtools crashes on calibration dates it doesn't understand, so we use a shadow xmlcon with fixed dates
+        if kwargs.get('normalize_xmlcon', True) and self.xmlcon and sources.exists(self.xmlcon):
+            self.xmlcon = xmlcon_normalizer.normalize(self.xmlcon, kwargs.get('shadow_folder'))
+
     def parse_lat_lon(self) -> (float, float):
         """Parses the hexfile and looks for NMEA coordinates. Parses them from degrees
-        and decimal minutes (DD) to degrees."""
-        with open(self.hex, 'r') as opened_hex_file:
-            hex_content = opened_hex_file.read()
-        lat = re.search(r'^\* NMEA Latitude = (\d{2}) ([\d\.]+) (\w)$',
-                        hex_content, re.M)
-        lon = re.search(r'^\* NMEA Longitude = (\d{3}) ([\d\.]+) (\w)$',
-                        hex_content, re.M)
-        if not lat or not lon:
-            warnings.warn(
-                f"Your hexfile ({self.hex.stem}) doesn't have coordinates! SHARKtools will fail!")
-            return None
-        d, m, SN = lat.groups()
-        lat_DD = (-1 if SN == "S" else 1) * (int(d) + float(m) / 60.)
-        d, m, EW = lon.groups()
-        lon_DD = (-1 if EW == "W" else 1) * (int(d) + float(m) / 60.)
-        return lat_DD, lon_DD
+        and decimal minutes (DD) to degrees.
+        If the hexfile has none, the coordinate providers are asked in order."""
+        coords = parse_header_lat_lon(read_hex_header(self.hex))
+        if not coords:
+            coords = self.provided_coords()
+            if not coords:
+                warnings.warn(
+                    f"Your hexfile ({self.hex.stem}) doesn't have coordinates! SHARKtools will fail!")
+        return coords
+
+    def provided_coords(self) -> (float, float):
+        """Coordinates of the first coordinate provider that knows this measurement, else None."""
+        for provider in self.coordinate_providers:
+            coords = provider.get_coords(self)
+            if coords:
+                return coords
+        return None
+
+    def parse_system_utc(self) -> datetime.datetime:
+        return parse_header_system_utc(read_hex_header(self.hex))
 
     def create_datcnv_psa(self, force: bool = False, include_upcast: bool = False, for_ros_file: bool = False) -> Path:
         psa_filename = Path(self.psa_folder,
@@ -434,73 +775,213 @@ class SBE911_Measurement:
         self.psa_dict['bottlesum'] = psa_filename
         return psa_filename
 
-    def create_all_psa(self, force=False):
-        self.create_datcnv_psa(force=force)
+    def create_all_psa(self, force=False, with_bottles=False):
+        """with_bottles converts the whole cast once into a .cnv and .ros. The downcast products are
+        derived from the full cast (binavg only averages the downcast) and the bottles from the .ros.
+        The bottle files are then {stem}.ros and {stem}.btl, not {stem}_u.ros and {stem}_u.btl as with two conversions."""
+        self.create_datcnv_psa(force=force, include_upcast=with_bottles, for_ros_file=with_bottles)
         self.create_filter_psa(force=force)
         self.create_alignctd_psa(force=force)
         self.create_celltm_psa()
         self.create_loopedit_psa()
         self.create_derive_psa(force=force)
         self.create_binavg_psa()
+        if with_bottles:
+            self.create_bottlesum_psa(force=force)
 
     def create_btl_files(self, force=False):
         self.create_datcnv_psa(force=force, include_upcast=True, for_ros_file=True)
         self.create_bottlesum_psa(force=force)
 
+    def batch_line(self, name: str, file: Path, append: str = '') -> str:
+        """The line running one psa in a sbebatch file."""
+        require_xmlcon = ['datcnv', 'derive', 'bottlesum']
+        return (f'{name} /p{file} /o{self.output_folder}' +
+                (f' /c{self.xmlcon}' if name in require_xmlcon else '') +
+                f' /i{stages.stage_input(self, name, append)}' +
+                (f' /a{append}' if append and name == "datcnv" else '') +
+                '\n')
+
     def create_sbe_batch_file(self, force: bool = False, append: str = ''):
         batch_name = Path(self.psa_folder, f'batch_{self.hex.stem}{append}.txt')
-        if force or not batch_name.is_file():
-            require_xmlcon = ['datcnv', 'derive', 'bottlesum']
-            input_ending = {
-                "bottlesum": ".ros"
-            }
+        # Extracted sources live in a scratch folder that is gone next time, the batch file can't be reused then
+        if force or self.sources_extracted or not batch_name.is_file():
             with open(batch_name, 'w') as sbe_params:
                 for name, file in self.psa_dict.items():
-                    sbe_params.write(
-                        f'{name} /p{file} /o{self.output_folder}' +
-                        (f' /c{self.xmlcon}' if name in require_xmlcon else '') +
-                        f' /i{self.hex if name == "datcnv" else Path(self.output_folder, self.hex.stem + append).with_suffix(input_ending.get(name, ".cnv"))}' +
-                        (f' /a{append}' if append and name == "datcnv" else '') +
-                        '\n'
-                    )
+                    sbe_params.write(self.batch_line(name, file, append))
         self.batch_file = batch_name
+        self.batch_append = append
         return batch_name
 
-    def run_batch(self):
-        subprocess.call([
-            'sbebatch.exe',
-            self.batch_file,
-            self.output_folder
-        ])
+    def backend(self, name: str) -> stages.StageBackend:
+        return self.backends.get(name, self.default_backend)
+
+    def run_batch(self) -> int:
+        """Runs the batch, raises if a stage fails (subprocess.CalledProcessError for sbebatch)."""
+        if not self.record_folder and all(isinstance(self.backend(name), stages.SBEBatchBackend)
+                                          for name in self.psa_dict):
+            # Everything on SBE Data Processing, the batch file already has it all
+            return subprocess.run([
+                self.sbebatch,
+                self.batch_file,
+                self.output_folder
+            ], check=True).returncode
+        return self.run_stages()
+
+    def run_stages(self) -> int:
+        """Runs the stages of psa_dict, each on its backend. Consecutive stages on the same backend are
+        handed over together, so external stages share a sbebatch call and native ones the table in memory.
+        A failing stage raises, so like run_batch this only returns 0."""
+        # Fail before the first stage ran, not halfway through the cast
+        for name in self.psa_dict:
+            if not self.backend(name).supports(name):
+                raise NotImplementedError(f"{type(self.backend(name)).__name__} can't run {name}")
+        groups = []
+        for name, file in self.psa_dict.items():
+            backend = self.backend(name)
+            # Recording needs the output of every single stage
+            if groups and groups[-1][0] is backend and not self.record_folder:
+                groups[-1][1].append((name, file))
+            else:
+                groups.append((backend, [(name, file)]))
+
+        data = stages.StageData(self.hex)
+        for backend, group in groups:
+            if not backend.in_memory:
+                data.to_disk()
+            start = time.perf_counter()
+            data = backend.run(self, group, data, self.batch_append)
+            # The bottle batch (_u) runs the same stages as the main one
+            self.stage_durations['+'.join(name for name, _ in group) + self.batch_append] = time.perf_counter() - start
+            if self.record_folder:
+                stages.record_stage(group[0][0], data, self.record_folder)
+        data.to_disk()
+        return 0
+
+    @contextlib.contextmanager
+    def sources_on_disk(self):
+        """External tools need real files. A hex, xmlcon and bl in an archive or .gz are extracted
+        (per cast, next to each other) for as long as this is open. Plain files are used as they are."""
+        hex_file, xmlcon = self.hex, self.xmlcon
+        with sources.on_disk([self.hex, self.xmlcon, self.hex.with_suffix('.bl')], self.scratch_folder) as real_paths:
+            self.hex, self.xmlcon, _ = real_paths
+            self.sources_extracted = (self.hex, self.xmlcon) != (hex_file, xmlcon)
+            try:
+                yield
+            finally:
+                self.hex, self.xmlcon = hex_file, xmlcon
+                self.sources_extracted = False
 
     def just_do_stuff(self, force: bool = True):
-        # The bottle file must have the same stem as hex for seabird!
-        possible_bl = self.hex.with_suffix('.bl')
-        if possible_bl.is_file() and valid_bl_file(possible_bl):
-            self.create_btl_files(force=force)
-            self.create_sbe_batch_file(force=force, append='_u')
+        self.processed_psa = dict()
+        self.stage_durations = dict()
+        self.products = []
+        with self.sources_on_disk():
+            # The bottle file must have the same stem as hex for seabird!
+            possible_bl = self.hex.with_suffix('.bl')
+            has_bottles = sources.exists(possible_bl) and valid_bl_file(possible_bl)
+            if has_bottles and not self.single_conversion:
+                start = time.perf_counter()
+                self.create_btl_files(force=force)
+                self.create_sbe_batch_file(force=force, append='_u')
+                self.stage_durations['bottle_psa'] = time.perf_counter() - start
+                self.processed_psa.update({f'{name}_u': file for name, file in self.psa_dict.items()})
+                start = time.perf_counter()
+                self.run_batch()
+                self.stage_durations['bottle_batch'] = time.perf_counter() - start
+
+            self.psa_dict = dict()
+            start = time.perf_counter()
+            self.create_all_psa(force=force, with_bottles=has_bottles and self.single_conversion)
+            self.create_sbe_batch_file(force=force)
+            self.stage_durations['psa'] = time.perf_counter() - start
+            self.processed_psa.update(self.psa_dict)
+            start = time.perf_counter()
             self.run_batch()
-
-        self.psa_dict = dict()
-        self.create_all_psa(force=force)
-        self.create_sbe_batch_file(force=force)
-        self.run_batch()
+            self.stage_durations['batch'] = time.perf_counter() - start
+
+    def run_qc(self, config: str = 'qc.yaml') -> dict:
+        """Automatic QC of the processed cnv, the flags and a summary are written to output_folder/qc.
+        See config/qc.yaml for the tests."""
+        # Imported here, so numpy is only needed by those who run the QC
+        import qc
+        start = time.perf_counter()
+        self.qc_summary = qc.run_qc(Path(self.output_folder, f'{self.hex.stem}.cnv'), config)
+        self.stage_durations['qc'] = time.perf_counter() - start
+        self.products += [Path(self.output_folder, 'qc', f'{self.hex.stem}_qc_flags.csv'),
+                          Path(self.output_folder, 'qc', f'{self.hex.stem}_qc.yaml')]
+        if self.qc_summary['flagged_bins']:
+            warnings.warn(f"QC flagged {self.qc_summary['flagged_bins']} of {self.qc_summary['bins']} bins of {self.hex.stem}, see {Path(self.output_folder, 'qc')}")
+        return self.qc_summary
 
 
 class SHARKTOOLS_Measurement(SBE911_Measurement):
     """And SBE911 measurement with special changes done so the resulting files can be run through SHARKTOOLS"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.hex and sources.exists(self.hex):
+            self.shadow_hex(kwargs.get('shadow_folder'))
+
+    def ask_coords(self) -> (float, float):
+        """Last resort if neither the hex nor a coordinate provider has coordinates, the GUI asks the user.
+        None gives up."""
+        return None
+
+    def shadow_hex(self, shadow_folder: Path | None = None) -> None:
+        """SHARKtools crashes if there is no NMEA Latitude and Longitude in the hex header.
+        For such casts a shadow hex (shadow/{name}) with the coordinates of the providers (or ask_coords)
+        in the header is used instead. An existing shadow hex is reused as long as it is up to date."""
+        if parse_header_lat_lon(read_hex_header(self.hex)):
+            return
+        if shadow_folder is None:
+            shadow_folder = Path(sources.disk_folder(self.hex), 'shadow')
+        shadow_file = Path(shadow_folder, self.hex.name)
+        coords = self.provided_coords()
+        if shadow_file.is_file() and shadow_file.stat().st_mtime_ns >= sources.state(self.hex)[1]:
+            shadow_header = read_hex_header(shadow_file)
+            # Coordinates typed in by the user are kept, unless a provider knows better now
+            if parse_header_lat_lon(shadow_header) and (not coords or format_nmea_header(*coords) in shadow_header):
+                self.shadow_bl(shadow_folder)
+                self.hex = shadow_file
+                return
+        coords = coords or self.ask_coords()
+        if not coords:
+            warnings.warn(f"Your hexfile ({self.hex.stem}) doesn't have coordinates! SHARKtools will fail!")
+            return
+        if not shadow_folder.is_dir():
+            os.makedirs(shadow_folder, exist_ok=True)
+        # Written aside and moved into place, so parallel workers never read half a file
+        temporary = Path(shadow_folder, f'.{shadow_file.name}.{os.getpid()}.tmp')
+        with sources.open_source(self.hex, 'r') as opened_hex_file, open(temporary, 'w') as opened_shadow_file:
+            inserted = False
+            for line in opened_hex_file:
+                if not inserted and line.startswith(('* SBE 11plus', '*END*')):
+                    opened_shadow_file.write(format_nmea_header(*coords))
+                    inserted = True
+                opened_shadow_file.write(line)
+        os.replace(temporary, shadow_file)
+        self.shadow_bl(shadow_folder)
+        self.hex = shadow_file
+
+    def shadow_bl(self, shadow_folder: Path) -> None:
+        """The bottle file has to stay next to the hex for seabird, so it follows it into the shadow folder."""
+        possible_bl = self.hex.with_suffix('.bl')
+        if not sources.exists(possible_bl) or not valid_bl_file(possible_bl):
+            return
+        temporary = Path(shadow_folder, f'.{possible_bl.name}.{os.getpid()}.tmp')
+        with sources.open_source(possible_bl, 'rb') as bl_file, open(temporary, 'wb') as shadow_bl_file:
+            shutil.copyfileobj(bl_file, shadow_bl_file)
+        os.replace(temporary, Path(shadow_folder, possible_bl.name))
+
     def build_sharktools_name(self) -> Path:
         """sbe09_{pressuresensor:04d}_{datetime.strfrmtime('%Y%m%d_%H%M')}_Ship(d2w2)_cruise_serno"""
-        xmlcon = ET.parse(self.xmlcon).getroot()
+        with sources.open_source(self.xmlcon, 'rb') as opened_xmlcon_file:
+            xmlcon = ET.parse(opened_xmlcon_file).getroot()
         pressure_sensor = xmlcon.find('.//PressureSensor/SerialNumber').text
         assert pressure_sensor != ""
-        with open(self.hex, 'r') as hex:
-            hex_data = hex.read()
-            date = re.search(r'^\* System UTC = ([\w \d:]*)$', hex_data, re.M)
-            assert date
-            measurement_start = datetime.datetime.strptime(date[1], '%b %d %Y %H:%M:%S')
-            measurement_start_str = measurement_start.strftime('%Y%m%d_%H%M')
-            # * System UTC = May 17 2023 10:50:11
+        measurement_start = self.parse_system_utc()
+        assert measurement_start
+        measurement_start_str = measurement_start.strftime('%Y%m%d_%H%M')
         with open(Path(get_base_path(), 'config', 'expedition_specific.yaml'),
                   'r') as yaml_file:
             extra_data = yaml.safe_load(yaml_file)
@@ -514,6 +995,7 @@ class SHARKTOOLS_Measurement(SBE911_Measurement):
         if not sharktools_name.parent.is_dir():
             os.makedirs(sharktools_name.parent)
         shutil.copyfile(cnv_name, sharktools_name)
+        self.products.append(sharktools_name.absolute())
 
     def fix_units(self, destination_folder="data/output"):
         """SHARKtools will crash if the Licor sensor has no units (specifically if there is no [] in the name)"""
@@ -525,7 +1007,10 @@ class SHARKTOOLS_Measurement(SBE911_Measurement):
         with open(sharktools_name, 'w') as sharktools_file:
             sharktools_file.write(data.replace('par: PAR/Irradiance, Biospherical/Licor', 'par: PAR/Irradiance, Biospherical/Licor [µE/(cm^2*s)]'))
 
-    def just_do_stuff(self, force: bool = True,  destination_folder: str | Path ="data/select_this_one_for_sharktools"):
+    def just_do_stuff(self, force: bool = True,  destination_folder: str | Path ="data/select_this_one_for_sharktools",
+                      qc: bool = True):
         super().just_do_stuff(force=force)
+        if qc:
+            self.run_qc()
         self.rename(destination_folder)
         self.fix_units(destination_folder)
@@ -0,0 +1,306 @@
+"""Processing whole archives on several machines.
+
+A coordinator fills a SQLite job table with the casts of one or more folders, workers on any
+host that can see the database and the data claim casts one at a time with a lease, keep the
+lease alive with heartbeats while the cast is processed and write the result back.
+If a worker dies its lease expires and the cast is handed out again.
+
+    python work_queue.py coordinator queue.sqlite data/raw/cruise_1 data/raw/cruise_2
+    python work_queue.py worker queue.sqlite --output-folder data/output
+    python work_queue.py status queue.sqlite
+
+SQLite locking needs a filesystem with working POSIX locks (local disk, NFSv4, SMB with
+locking enabled). Every host must see the casts under the same path.
+"""
+import argparse
+import contextlib
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import warnings
+from pathlib import Path
+
+import tunatools
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def now() -> float:
+    return time.time()
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """A job table of casts in a SQLite database. Every claim/heartbeat/result is one short transaction."""
+    def __init__(self, db_file: Path, timeout: float = 60.):
+        self.db_file = Path(db_file)
+        self.timeout = timeout
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                hex TEXT UNIQUE NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started REAL,
+                finished REAL,
+                duration REAL,
+                result TEXT,
+                error TEXT
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+
+    @contextlib.contextmanager
+    def connect(self):
+        # isolation_level=None so we decide when a transaction starts (BEGIN IMMEDIATE takes the write lock)
+        db = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+        try:
+            yield db
+        finally:
+            # An uncommitted transaction is rolled back on close
+            db.close()
+
+    def add(self, hex_files) -> int:
+        """Queues the casts, casts already in the queue are left alone. Returns the number of new jobs."""
+        with self.connect() as db:
+            before = db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR IGNORE INTO jobs (hex) VALUES (?)",
+                           [(str(Path(hex_file).absolute()),) for hex_file in hex_files])
+            db.execute("COMMIT")
+            return db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] - before
+
+    def claim(self, worker: str, lease: float, max_attempts: int = 3):
+        """Atomically hands out a pending job or one whose lease expired. Returns (id, hex) or None.
+        Jobs that already expired max_attempts times are marked failed instead."""
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            t = now()
+            db.execute("UPDATE jobs SET status = ?, worker = NULL, error = 'lease expired too often' "
+                       "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                       (FAILED, RUNNING, t, max_attempts))
+            job = db.execute("SELECT id, hex FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+                             "ORDER BY attempts, id LIMIT 1",
+                             (PENDING, RUNNING, t)).fetchone()
+            if job:
+                db.execute("UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+                           "started = ?, error = NULL WHERE id = ?",
+                           (RUNNING, worker, t + lease, t, job[0]))
+            db.execute("COMMIT")
+        return job
+
+    def heartbeat(self, job_id: int, worker: str, lease: float) -> bool:
+        """Extends the lease. False if the job isn't ours anymore (our lease expired and it was handed out again)."""
+        with self.connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+                                (now() + lease, job_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: int, worker: str, status: str, result: str | None = None,
+               error: str | None = None) -> bool:
+        """Writes the result back. False if the job isn't ours anymore, then nothing is written."""
+        t = now()
+        with self.connect() as db:
+            cursor = db.execute("UPDATE jobs SET status = ?, finished = ?, duration = ? - started, result = ?, "
+                                "error = ?, lease_until = NULL WHERE id = ? AND worker = ? AND status = ?",
+                                (status, t, t, result, error, job_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def retry_failed(self) -> int:
+        """Puts all failed jobs back in the queue."""
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET status = ?, attempts = 0, worker = NULL WHERE status = ?",
+                              (PENDING, FAILED)).rowcount
+
+    def status(self) -> dict:
+        with self.connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def jobs(self, status: str | None = None) -> list[tuple]:
+        with self.connect() as db:
+            query = "SELECT id, hex, status, worker, attempts, duration, result, error FROM jobs"
+            if status:
+                return db.execute(query + " WHERE status = ? ORDER BY id", (status,)).fetchall()
+            return db.execute(query + " ORDER BY id").fetchall()
+
+
+class Heartbeat(threading.Thread):
+    """Keeps the lease of a job alive while the cast is processed."""
+    def __init__(self, queue: WorkQueue, job_id: int, worker: str, lease: float, interval: float):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.job_id = job_id
+        self.worker = worker
+        self.lease = lease
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.job_id, self.worker, self.lease):
+                    self.lost = True
+                    return
+            except sqlite3.OperationalError:
+                # Database busy for too long, try again next beat. The lease is long enough for a few misses.
+                continue
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def process_cast(hex_file: Path, measurement_class=tunatools.SHARKTOOLS_Measurement,
+                 destination_folder: Path | None = None, **kwargs) -> Path:
+    """The same per cast pipeline as processing a folder, returns the processed cnv.
+    destination_folder is where SHARKtools measurements put their renamed copy."""
+    hex_file = Path(hex_file)
+    sm = measurement_class(hex_file, source_folder=hex_file.parent, **kwargs)
+    if destination_folder is not None and isinstance(sm, tunatools.SHARKTOOLS_Measurement):
+        sm.just_do_stuff(destination_folder=destination_folder)
+    else:
+        sm.just_do_stuff()
+    cnv_name = Path(sm.output_folder, f'{sm.hex.stem}.cnv')
+    if not cnv_name.is_file():
+        raise FileNotFoundError(f"{sm.sbebatch} did not produce {cnv_name}")
+    return cnv_name
+
+
+def publish(staging: Path, target: Path):
+    """Moves the files of a claim into place, each one in a single step, so readers never see half a file
+    and the last writer wins per file. Batch files stay behind, they point into the staging folder."""
+    for path in sorted(staging.rglob('*')):
+        if path.is_file() and not path.name.startswith('batch_'):
+            destination = Path(target, path.relative_to(staging))
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, destination)
+
+
+def run_worker(db_file: Path, lease: float = 600., heartbeat: float = 60., max_attempts: int = 3,
+               max_jobs: int | None = None, poll: float = 0.,
+               destination_folder: Path = Path('data', 'select_this_one_for_sharktools'), **kwargs) -> int:
+    """Claims and processes casts until the queue is empty (or max_jobs are done).
+    poll > 0 waits that many seconds for new jobs instead of stopping. Returns the number of processed jobs.
+    kwargs are passed on to the measurement (output_folder, psa_folder, sbebatch, ...).
+
+    Every claim is processed into its own staging folders (.claims/{job}_{worker} in the output, psa and
+    SHARKtools folders) and only published if the lease is still ours. So a worker whose lease expired
+    and the worker that took the cast over never write into the same files."""
+    queue = WorkQueue(db_file)
+    worker = worker_name()
+    targets = [Path(kwargs.pop('output_folder', Path('data', 'output'))),
+               Path(kwargs.pop('psa_folder', Path('data', 'psa_files'))),
+               Path(destination_folder)]
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        job = queue.claim(worker, lease, max_attempts)
+        if not job:
+            if poll <= 0:
+                break
+            time.sleep(poll)
+            continue
+        job_id, hex_file = job
+        claim = f'{job_id}_' + re.sub(r'[^\w.-]', '_', worker)
+        output_folder, psa_folder, sharktools_folder = [Path(target, '.claims', claim) for target in targets]
+        beat = Heartbeat(queue, job_id, worker, lease, heartbeat)
+        beat.start()
+        try:
+            result = process_cast(Path(hex_file), output_folder=output_folder, psa_folder=psa_folder,
+                                  destination_folder=sharktools_folder, **kwargs)
+        except Exception:
+            status, result, error = FAILED, None, traceback.format_exc()
+        else:
+            status, error = DONE, None
+        beat.stop()
+        # If our lease expired the cast was handed out again, the worker that has it now writes the result
+        if beat.lost or not queue.heartbeat(job_id, worker, lease):
+            warnings.warn(f'{worker} lost the lease of {hex_file}, its result is discarded')
+            for target in targets:
+                shutil.rmtree(Path(target, '.claims', claim), ignore_errors=True)
+            continue
+        if status == DONE:
+            for target in targets:
+                publish(Path(target, '.claims', claim), target)
+            result = str(Path(targets[0], result.name).absolute())
+        for target in targets:
+            # Ours and those left by workers that died on this cast
+            for leftover in Path(target, '.claims').glob(f'{job_id}_*'):
+                shutil.rmtree(leftover, ignore_errors=True)
+        if not queue.finish(job_id, worker, status, result=result, error=error):
+            warnings.warn(f'{worker} lost the lease of {hex_file} while publishing, '
+                          f'its files may be overwritten by the worker that has it now')
+            continue
+        processed += 1
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    coordinator = commands.add_parser('coordinator', help='Queue all casts of the folders')
+    coordinator.add_argument('db')
+    coordinator.add_argument('folders', nargs='+')
+    coordinator.add_argument('--recursive', action='store_true')
+    coordinator.add_argument('--retry-failed', action='store_true')
+
+    worker = commands.add_parser('worker', help='Process casts until the queue is empty')
+    worker.add_argument('db')
+    worker.add_argument('--output-folder', default='data/output')
+    worker.add_argument('--psa-folder', default='data/psa_files')
+    worker.add_argument('--destination-folder', default='data/select_this_one_for_sharktools',
+                        help='Where SHARKtools measurements put their renamed copy')
+    worker.add_argument('--sbebatch', default='sbebatch.exe')
+    worker.add_argument('--measurement', default='SHARKTOOLS_Measurement',
+                        help='Name of the measurement class in tunatools')
+    worker.add_argument('--lease', type=float, default=600.)
+    worker.add_argument('--heartbeat', type=float, default=60.)
+    worker.add_argument('--max-attempts', type=int, default=3)
+    worker.add_argument('--poll', type=float, default=0.)
+    worker.add_argument('--single-conversion', action='store_true',
+                        help='Convert casts with bottles once for the downcast and bottle products')
+
+    status = commands.add_parser('status', help='Show how far the queue is')
+    status.add_argument('db')
+    status.add_argument('--failed', action='store_true', help='List the failed casts with their errors')
+
+    args = parser.parse_args(argv)
+    if args.command == 'coordinator':
+        queue = WorkQueue(args.db)
+        hex_files = [hex_file for folder in args.folders
+                     for hex_file in tunatools.discover_casts(folder, recursive=args.recursive)]
+        print(f'Queued {queue.add(hex_files)} new casts')
+        if args.retry_failed:
+            print(f'Requeued {queue.retry_failed()} failed casts')
+    elif args.command == 'worker':
+        processed = run_worker(args.db, lease=args.lease, heartbeat=args.heartbeat,
+                               max_attempts=args.max_attempts, poll=args.poll,
+                               measurement_class=getattr(tunatools, args.measurement),
+                               output_folder=args.output_folder, psa_folder=args.psa_folder,
+                               destination_folder=args.destination_folder,
+                               sbebatch=args.sbebatch, single_conversion=args.single_conversion)
+        print(f'{worker_name()} processed {processed} casts')
+    elif args.command == 'status':
+        queue = WorkQueue(args.db)
+        for state, count in sorted(queue.status().items()):
+            print(f'{state}: {count}')
+        if args.failed:
+            for job_id, hex_file, _, worker, attempts, _, _, error in queue.jobs(FAILED):
+                print(f'{hex_file} ({attempts} attempts, {worker}):\n{error}')
+
+
+if __name__ == "__main__":
+    main()